@@ -1,38 +1,270 @@
-from bottle import route, run, request
-import subprocess
+import bottle
+from bottle import route, request, response, abort, default_app
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, make_server
+import contextlib
+import glob
+import hashlib
 import json
+import os
+import queue
+import signal
+import threading
+import time
+import uuid
 
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
-def execute(args, cwd=None):
-    process = subprocess.Popen(args,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               text=True,
-                               cwd=cwd)
-    stdout, stderr = process.communicate()
-    retcode = process.returncode
-    return stdout, stderr, retcode
+from octopus_client import OctopusClient
+
+# The number of runbooks that can be triggered at the same time
+worker_count = int(os.environ.get('GITEA_PROXY_WORKERS', '4'))
+# Events are saved to disk until they are processed, so queued events survive a restart
+queue_dir = os.environ.get('GITEA_PROXY_QUEUE_DIR', '/tmp/giteaproxy_queue')
+# The number of seconds the space, project, runbook and environment IDs are cached for
+lookup_ttl = int(os.environ.get('GITEA_PROXY_LOOKUP_TTL', '300'))
+# The number of HTTP requests that can be handled at the same time
+server_threads = int(os.environ.get('GITEA_PROXY_SERVER_THREADS', '8'))
+# Webhook bodies larger than this are rejected with a 413 response
+max_body_bytes = int(os.environ.get('GITEA_PROXY_MAX_BODY_BYTES', str(5 * 1024 * 1024)))
+# The number of seconds to wait for running runbook triggers to complete when shutting down
+shutdown_timeout = int(os.environ.get('GITEA_PROXY_SHUTDOWN_TIMEOUT', '30'))
+
+# Bottle rejects request bodies larger than MEMFILE_MAX with its own error, so the limit is raised to the
+# configured one, and the body size is checked when the webhook is received
+bottle.BaseRequest.MEMFILE_MAX = max_body_bytes
+
+octopus_client = OctopusClient(os.environ.get('OCTOPUS_SERVER', 'http://octopus:8080'),
+                               os.environ.get('OCTOPUS_API_KEY', 'API-AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'),
+                               pool_size=max(1, worker_count),
+                               cache_ttl=lookup_ttl)
+
+event_queue = queue.Queue()
+pending_events = set()
+running_events = set()
+pending_lock = threading.Lock()
+stopping = threading.Event()
+
+queue_depth = Gauge('giteaproxy_queue_depth', 'The number of events waiting to be processed')
+queue_depth.set_function(lambda: len(pending_events))
+running_depth = Gauge('giteaproxy_running_events', 'The number of events being processed')
+running_depth.set_function(lambda: len(running_events))
+webhook_latency = Histogram('giteaproxy_webhook_request_seconds', 'The time taken to accept a webhook')
+webhooks_received = Counter('giteaproxy_webhooks_total', 'The number of webhooks received', ['result'])
+runbook_latency = Histogram('giteaproxy_runbook_trigger_seconds', 'The time taken to trigger a runbook',
+                            buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+runbook_triggers = Counter('giteaproxy_runbook_triggers_total', 'The number of runbook triggers', ['result'])
+
+
+def get_event_key(event):
+    """
+    Builds the key used to queue an event. Events with the same action for the same pull request head commit trigger
+    identical PR checks, so they share a key and are coalesced while waiting in the queue or running. Events with a
+    different action, such as closing the pull request, are kept, as the runbook may handle them differently. Any
+    other event is queued individually.
+    :param event: The webhook payload
+    :return: The key identifying the queued event
+    """
+    pull_request = event.get('pull_request') if isinstance(event, dict) else None
+    if not pull_request:
+        return uuid.uuid4().hex
+
+    repository = event.get('repository') or {}
+    head = pull_request.get('head') or {}
+    identity = json.dumps([repository.get('full_name'), pull_request.get('number'), head.get('sha'),
+                           event.get('action')])
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+def enqueue_event(key, body):
+    """
+    Saves an event to the queue directory and queues it for a worker. If an event with the same key is already
+    waiting, the saved body is replaced with the latest one, and the event is not queued a second time. If an event
+    with the same key is already running, the new event is dropped, as it would trigger the same check.
+    :param key: The key identifying the event
+    :param body: The event body passed to the runbook
+    :return: True if the event was queued, and False if it was coalesced with a waiting or running event
+    """
+    event_file = os.path.join(queue_dir, key + '.json')
+
+    with pending_lock:
+        if key in running_events:
+            return False
+
+        with open(event_file + '.tmp', 'w') as f:
+            f.write(body)
+        os.replace(event_file + '.tmp', event_file)
+
+        if key in pending_events:
+            return False
+        pending_events.add(key)
+
+    event_queue.put(key)
+    return True
+
+
+def recover_events():
+    """
+    Queues the events that were saved to disk but not processed before the proxy last stopped.
+    """
+    os.makedirs(queue_dir, exist_ok=True)
+
+    # Events that were being processed are run again
+    for inflight_file in glob.glob(os.path.join(queue_dir, '*.inflight')):
+        try:
+            os.replace(inflight_file, inflight_file[:-len('.inflight')] + '.json')
+        except OSError as ex:
+            print('Failed to recover event ' + os.path.basename(inflight_file) + ': ' + str(ex))
+
+    for event_file in sorted(glob.glob(os.path.join(queue_dir, '*.json')), key=os.path.getmtime):
+        pending_events.add(os.path.basename(event_file)[:-len('.json')])
+        event_queue.put(os.path.basename(event_file)[:-len('.json')])
+
+
+def run_runbook(body):
+    # The body is encoded as a JSON string, matching the value previously passed by the octo CLI, which the
+    # PR Check runbook decodes twice
+    runbook_run = octopus_client.run_runbook('Default', 'PR Checks', 'PR Check', 'Sync',
+                                             {'Webhook.Pr.Body': json.dumps(body)})
+
+    print('Started runbook run ' + runbook_run['Id'] + ' for task ' + runbook_run['TaskId'])
+
+
+def process_events():
+    """
+    Runs the runbook for each queued event. Each worker thread processes one event at a time, and stops taking new
+    events once the proxy is shutting down. Events left in the queue remain on disk for the next start.
+    """
+    while not stopping.is_set():
+        try:
+            key = event_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+
+        event_file = os.path.join(queue_dir, key + '.json')
+        inflight_file = os.path.join(queue_dir, key + '.inflight')
+
+        with pending_lock:
+            pending_events.discard(key)
+            try:
+                os.replace(event_file, inflight_file)
+            except OSError as ex:
+                # The event file was removed from the queue directory, so there is nothing to run
+                print('Failed to read event ' + key + ': ' + str(ex))
+                event_queue.task_done()
+                continue
+            running_events.add(key)
+
+        start = time.monotonic()
+        try:
+            with open(inflight_file) as f:
+                run_runbook(f.read())
+            runbook_triggers.labels('success').inc()
+        except Exception as ex:
+            runbook_triggers.labels('failure').inc()
+            print('Failed to process event ' + key + ': ' + str(ex))
+        finally:
+            runbook_latency.observe(time.monotonic() - start)
+            with pending_lock:
+                running_events.discard(key)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(inflight_file)
+            event_queue.task_done()
 
 
 @route('/', method='POST')
+@webhook_latency.time()
 def index():
-    body = json.dumps(request.json)
+    # Chunked requests do not have a content length, so the size of the body is also checked once it is read
+    data = request.body.read(max_body_bytes + 1) if request.content_length <= max_body_bytes else None
+    if data is None or len(data) > max_body_bytes:
+        webhooks_received.labels('rejected').inc()
+        abort(413, 'The webhook body exceeds ' + str(max_body_bytes) + ' bytes')
+
+    try:
+        event = json.loads(data or b'null')
+    except ValueError:
+        webhooks_received.labels('rejected').inc()
+        abort(400, 'The webhook body is not valid JSON')
+
+    body = json.dumps(event)
 
     print(body)
 
-    stdout, stderr, _ = execute(
-        ['/usr/bin/octo',
-         'run-runbook',
-         '--server', 'http://octopus:8080',
-         '--apiKey', 'API-AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA',
-         '--space', 'Default',
-         '--project', 'PR Checks',
-         '--runbook', 'PR Check',
-         '--environment', 'Sync',
-         '--variable', 'Webhook.Pr.Body:' + json.dumps(body)])
+    key = get_event_key(event)
+    queued = enqueue_event(key, body)
+    webhooks_received.labels('queued' if queued else 'coalesced').inc()
+
+    # Gitea only waits a short time for a response, so the runbook is triggered in the background
+    response.status = 202
+    return {'event': key, 'queued': queued}
+
+
+@route('/metrics', method='GET')
+def metrics():
+    response.content_type = CONTENT_TYPE_LATEST
+    return generate_latest()
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    A WSGI server that handles requests on a fixed size thread pool, so a burst of webhooks is served concurrently
+    without creating a thread per connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # The pool is created first, as the server is closed if it fails to bind
+        self.request_pool = ThreadPoolExecutor(max_workers=max(1, server_threads))
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        self.request_pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        # Requests that were accepted are completed before the server is closed
+        self.request_pool.shutdown(wait=True)
+        super().server_close()
+
+
+def shutdown(signum, frame):
+    """
+    Stops accepting requests. The server is stopped from another thread, as shutdown() blocks until the server
+    loop running on the main thread exits.
+    """
+    print('Shutting down')
+    stopping.set()
+    threading.Thread(target=server.shutdown).start()
+
+
+def main():
+    global server
+
+    recover_events()
+
+    workers = [threading.Thread(target=process_events, daemon=True) for _ in range(max(1, worker_count))]
+    for worker in workers:
+        worker.start()
+
+    server = make_server('0.0.0.0', 4000, default_app(), PooledWSGIServer)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    print('Listening on http://0.0.0.0:4000/')
+    server.serve_forever()
+    server.server_close()
 
-    print(stdout)
-    print(stderr)
+    # Running runbook triggers are given time to complete
+    shutdown_deadline = time.monotonic() + shutdown_timeout
+    for worker in workers:
+        worker.join(max(0, shutdown_deadline - time.monotonic()))
 
 
-run(host='0.0.0.0', port=4000)
+if __name__ == '__main__':
+    main()
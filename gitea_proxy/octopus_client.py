@@ -0,0 +1,131 @@
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class OctopusClient:
+    """
+    A minimal Octopus REST API client. Requests share a pool of keep-alive connections, and the IDs looked up by
+    name are cached for a limited time, so triggering a runbook usually only needs a single request.
+    """
+
+    def __init__(self, server, api_key, pool_size=4, cache_ttl=300):
+        """
+        :param server: The Octopus server URL
+        :param api_key: The Octopus API key
+        :param pool_size: The number of connections kept open to the Octopus server
+        :param cache_ttl: The number of seconds IDs looked up by name are cached for
+        """
+        self.server = server.rstrip('/')
+        self.cache_ttl = cache_ttl
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.headers.update({'X-Octopus-ApiKey': api_key})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, **kwargs):
+        response = self.session.request(method, self.server + path, timeout=60, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def cached(self, key, lookup):
+        """
+        Returns a cached value, calling the lookup function if the value is missing or has expired.
+        :param key: The cache key
+        :param lookup: The function returning the value
+        :return: The cached value
+        """
+        with self.cache_lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return entry[0]
+
+        value = lookup()
+
+        with self.cache_lock:
+            self.cache[key] = (value, time.monotonic() + self.cache_ttl)
+        return value
+
+    def clear_cache(self):
+        with self.cache_lock:
+            self.cache.clear()
+
+    def find_by_name(self, path, name):
+        """
+        Finds a resource by its exact name.
+        :param path: The API path of the resource collection
+        :param name: The resource name
+        :return: The resource
+        """
+        resources = self.request('GET', path + '?take=10000&partialName=' + urllib.parse.quote(name))
+        # Some collections return a page of items, and others return a plain list
+        items = resources['Items'] if isinstance(resources, dict) else resources
+        matches = [item for item in items if item['Name'] == name]
+        if len(matches) == 0:
+            raise LookupError('Could not find "' + name + '" in ' + path)
+        return matches[0]
+
+    def get_runbook_run_template(self, space_name, project_name, runbook_name, environment_name):
+        """
+        Resolves the IDs required to run a published runbook snapshot.
+        :return: A dict with the space, runbook, snapshot and environment IDs, and the IDs of the prompted variable
+        form elements keyed by variable name
+        """
+        def lookup():
+            space_id = self.find_by_name('/api/spaces', space_name)['Id']
+            project_id = self.find_by_name('/api/' + space_id + '/projects', project_name)['Id']
+            runbook = self.find_by_name('/api/' + space_id + '/projects/' + project_id + '/runbooks', runbook_name)
+            environment_id = self.find_by_name('/api/' + space_id + '/environments', environment_name)['Id']
+            snapshot_id = runbook['PublishedRunbookSnapshotId']
+            if not snapshot_id:
+                raise LookupError('The runbook "' + runbook_name + '" has not been published')
+
+            preview = self.request('GET', '/api/' + space_id + '/runbookSnapshots/' + snapshot_id +
+                                   '/runbookRuns/preview/' + environment_id + '?includeDisabledSteps=true')
+            form_elements = {element['Control']['Name']: element['Name']
+                             for element in preview.get('Form', {}).get('Elements', [])}
+
+            return {'SpaceId': space_id, 'RunbookId': runbook['Id'], 'RunbookSnapshotId': snapshot_id,
+                    'EnvironmentId': environment_id, 'FormElements': form_elements}
+
+        return self.cached((space_name, project_name, runbook_name, environment_name), lookup)
+
+    def run_runbook(self, space_name, project_name, runbook_name, environment_name, variables):
+        """
+        Runs the published snapshot of a runbook.
+        :param variables: A dict of prompted variable values keyed by variable name
+        :return: The runbook run resource
+        """
+        try:
+            return self.create_runbook_run(space_name, project_name, runbook_name, environment_name, variables)
+        except (requests.HTTPError, LookupError) as ex:
+            if isinstance(ex, requests.HTTPError) and (ex.response is None or ex.response.status_code >= 500):
+                raise
+            # The runbook may have been republished since the IDs and prompted variables were cached, so look them
+            # up and try once more
+            self.clear_cache()
+            return self.create_runbook_run(space_name, project_name, runbook_name, environment_name, variables)
+
+    def create_runbook_run(self, space_name, project_name, runbook_name, environment_name, variables):
+        template = self.get_runbook_run_template(space_name, project_name, runbook_name, environment_name)
+
+        # Octopus ignores values that do not match a prompted variable, so the runbook would run without them
+        missing = [name for name in variables if name not in template['FormElements']]
+        if len(missing) != 0:
+            raise LookupError('The runbook "' + runbook_name + '" has no prompted variables called ' +
+                              ', '.join(missing))
+
+        form_values = {template['FormElements'][name]: value for name, value in variables.items()}
+
+        return self.request('POST', '/api/' + template['SpaceId'] + '/runbookRuns', json={
+            'RunbookId': template['RunbookId'],
+            'RunbookSnapshotId': template['RunbookSnapshotId'],
+            'EnvironmentId': template['EnvironmentId'],
+            'FormValues': form_values
+        })
@@ -0,0 +1,143 @@
+import http.client
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+# The proxy is configured when it is imported, so the settings are defined first
+os.environ['GITEA_PROXY_QUEUE_DIR'] = tempfile.mkdtemp()
+os.environ['GITEA_PROXY_MAX_BODY_BYTES'] = str(200 * 1024)
+
+import main
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookBodyLimitTest(unittest.TestCase):
+    """
+    Tests the webhook body size limit, which is larger than the default bottle request body limit of 100 KB
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        os.makedirs(main.queue_dir, exist_ok=True)
+        cls.server = make_server('127.0.0.1', 0, main.default_app(), handler_class=QuietHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def post(self, body, chunked=False):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=10)
+        try:
+            headers = {'Content-Type': 'application/json'}
+            if chunked:
+                connection.request('POST', '/', body=iter([body[i:i + 8192] for i in range(0, len(body), 8192)]),
+                                   headers=headers, encode_chunked=True)
+            else:
+                connection.request('POST', '/', body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    @staticmethod
+    def webhook(size):
+        return json.dumps({'padding': 'x' * size}).encode('utf-8')
+
+    @staticmethod
+    def rejected_count():
+        return main.webhooks_received.labels('rejected')._value.get()
+
+    def test_accepts_body_above_bottle_default_limit(self):
+        self.assertEqual(202, self.post(self.webhook(150 * 1024)))
+
+    def test_rejects_body_above_limit(self):
+        rejected = self.rejected_count()
+        self.assertEqual(413, self.post(self.webhook(250 * 1024)))
+        self.assertEqual(rejected + 1, self.rejected_count())
+
+    def test_accepts_chunked_body_below_limit(self):
+        self.assertEqual(202, self.post(self.webhook(150 * 1024), chunked=True))
+
+    def test_rejects_chunked_body_above_limit(self):
+        rejected = self.rejected_count()
+        self.assertEqual(413, self.post(self.webhook(250 * 1024), chunked=True))
+        self.assertEqual(rejected + 1, self.rejected_count())
+
+
+class EventKeyTest(unittest.TestCase):
+    """
+    Tests the keys used to coalesce queued events
+    """
+
+    @staticmethod
+    def event(action, sha='abc'):
+        return {'action': action, 'repository': {'full_name': 'octopus/project'},
+                'pull_request': {'number': 1, 'head': {'sha': sha}}}
+
+    def test_coalesces_same_action_and_commit(self):
+        self.assertEqual(main.get_event_key(self.event('synchronized')),
+                         main.get_event_key(self.event('synchronized')))
+
+    def test_keeps_different_actions(self):
+        self.assertNotEqual(main.get_event_key(self.event('opened')), main.get_event_key(self.event('closed')))
+
+    def test_keeps_different_commits(self):
+        self.assertNotEqual(main.get_event_key(self.event('synchronized', 'abc')),
+                            main.get_event_key(self.event('synchronized', 'def')))
+
+    def test_keeps_other_events(self):
+        self.assertNotEqual(main.get_event_key({'ref': 'refs/heads/main'}),
+                            main.get_event_key({'ref': 'refs/heads/main'}))
+
+
+class ProcessEventsTest(unittest.TestCase):
+    """
+    Tests the workers that run the runbook for queued events
+    """
+
+    def setUp(self):
+        os.makedirs(main.queue_dir, exist_ok=True)
+        self.bodies = []
+        patcher = mock.patch.object(main, 'run_runbook', self.bodies.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        worker = threading.Thread(target=main.process_events, daemon=True)
+        worker.start()
+        self.addCleanup(main.stopping.clear)
+        self.addCleanup(worker.join)
+        self.addCleanup(main.stopping.set)
+
+    def test_processes_queued_event(self):
+        self.assertTrue(main.enqueue_event('queued', '{"queued": true}'))
+        main.event_queue.join()
+        self.assertIn('{"queued": true}', self.bodies)
+        self.assertFalse(os.path.exists(os.path.join(main.queue_dir, 'queued.inflight')))
+
+    def test_skips_event_removed_from_queue_dir(self):
+        with main.pending_lock:
+            main.pending_events.add('removed')
+        main.event_queue.put('removed')
+        main.event_queue.join()
+        self.assertNotIn('removed', main.running_events)
+        self.assertNotIn('removed', main.pending_events)
+
+        # Later events with the same key are still processed
+        self.assertTrue(main.enqueue_event('removed', '{"removed": true}'))
+        main.event_queue.join()
+        self.assertIn('{"removed": true}', self.bodies)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+from octopus_client import OctopusClient
+
+
+class FakeOctopusClient(OctopusClient):
+    """
+    An Octopus client that answers requests from a fixed set of resources, where the prompted variables of the
+    runbook snapshot change each time the runbook is published
+    """
+
+    def __init__(self, published_variables):
+        super().__init__('http://octopus', 'API-TEST')
+        self.published_variables = published_variables
+        self.previews = 0
+        self.runs = []
+
+    def request(self, method, path, **kwargs):
+        if method == 'POST':
+            self.runs.append(kwargs['json'])
+            return {'Id': 'RunbookRuns-1', 'TaskId': 'ServerTasks-1'}
+        if '/runbookRuns/preview/' in path:
+            variables = self.published_variables[min(self.previews, len(self.published_variables) - 1)]
+            self.previews += 1
+            return {'Form': {'Elements': [{'Name': 'Element-' + name, 'Control': {'Name': name}}
+                                          for name in variables]}}
+        if path.startswith('/api/spaces?'):
+            return {'Items': [{'Id': 'Spaces-1', 'Name': 'Default'}]}
+        if '/projects/Projects-1/runbooks?' in path:
+            return {'Items': [{'Id': 'Runbooks-1', 'Name': 'PR Check',
+                               'PublishedRunbookSnapshotId': 'RunbookSnapshots-1'}]}
+        if '/projects?' in path:
+            return {'Items': [{'Id': 'Projects-1', 'Name': 'PR Checks'}]}
+        if '/environments?' in path:
+            return {'Items': [{'Id': 'Environments-1', 'Name': 'Sync'}]}
+        raise AssertionError('Unexpected request ' + method + ' ' + path)
+
+    def run(self, variables):
+        return self.run_runbook('Default', 'PR Checks', 'PR Check', 'Sync', variables)
+
+
+class RunRunbookTest(unittest.TestCase):
+    """
+    Tests the prompted variables passed when running a runbook
+    """
+
+    def test_passes_prompted_variables(self):
+        client = FakeOctopusClient([['Webhook.Pr.Body']])
+        client.run({'Webhook.Pr.Body': '{}'})
+        self.assertEqual({'Element-Webhook.Pr.Body': '{}'}, client.runs[0]['FormValues'])
+
+    def test_rejects_unknown_variables(self):
+        client = FakeOctopusClient([['Webhook.Pr.Body']])
+        with self.assertRaisesRegex(LookupError, 'Webhook.Pr.Url'):
+            client.run({'Webhook.Pr.Body': '{}', 'Webhook.Pr.Url': 'http://gitea'})
+        self.assertEqual(0, len(client.runs))
+
+    def test_finds_variables_of_republished_runbook(self):
+        client = FakeOctopusClient([['Webhook.Pr.Body'], ['Webhook.Pr.Body', 'Webhook.Pr.Url']])
+        client.run({'Webhook.Pr.Body': '{}'})
+        client.run({'Webhook.Pr.Body': '{}', 'Webhook.Pr.Url': 'http://gitea'})
+        self.assertEqual({'Element-Webhook.Pr.Body': '{}', 'Element-Webhook.Pr.Url': 'http://gitea'},
+                         client.runs[1]['FormValues'])
+        self.assertEqual(2, client.previews)
+
+
+if __name__ == '__main__':
+    unittest.main()
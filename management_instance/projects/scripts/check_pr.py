@@ -3,9 +3,12 @@ import json
 import os
 import shutil
 import sys
+import tempfile
+import hashlib
 from pathlib import Path
 from urllib.parse import urlparse
 import urllib.request
+import urllib.error
 import contextlib
 import base64
 
@@ -26,6 +29,209 @@ def execute(args, cwd=None):
     return stdout, stderr, retcode
 
 
+def gitea_request(url, data=None):
+    """
+    Sends a request to the Gitea API.
+    :param url: The API URL
+    :param data: The optional JSON body. The request is a POST if a body is supplied, and a GET otherwise.
+    :return: The raw response body
+    """
+    auth = base64.b64encode("octopus:Password01!".encode('ascii'))
+    auth_header = "Basic " + auth.decode('ascii')
+
+    headers = {
+        "Authorization": auth_header,
+        "Content-Type": "application/json"
+    }
+
+    request = urllib.request.Request(url, headers=headers,
+                                     data=json.dumps(data).encode('utf-8') if data is not None else None)
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+def get_commits(repo_url, pr):
+    """
+    Finds the commits checked for a PR without cloning the repo. The head commit is the one the check status is posted
+    for, and the tips of the default and base branches are read from the remote repo.
+    :param repo_url: The URL of the base repo
+    :param pr: The pull request from the webhook body
+    :return: A dict with the "default", "base" and "head" commits, or None if a branch could not be found
+    """
+    default_branch = pr['pull_request']['base']['repo']['default_branch']
+    base_ref = pr['pull_request']['base']['ref']
+
+    stdout, _, retcode = execute(['git', 'ls-remote', repo_url] +
+                                 list(dict.fromkeys(['refs/heads/' + default_branch, 'refs/heads/' + base_ref])))
+    if retcode != 0:
+        return None
+
+    branch_commits = {}
+    for line in stdout.splitlines():
+        commit, _, ref = line.partition('\t')
+        branch_commits[ref] = commit
+
+    if 'refs/heads/' + default_branch not in branch_commits or 'refs/heads/' + base_ref not in branch_commits:
+        return None
+
+    return {'default': branch_commits['refs/heads/' + default_branch],
+            'base': branch_commits['refs/heads/' + base_ref],
+            'head': pr['pull_request']['head']['sha']}
+
+
+def get_cache_key(api_url, commits):
+    """
+    Builds the key identifying a check result. The result of a check only depends on the base branch commit, the head
+    commit being merged, and the check files in the default branch. The check files are read from the Gitea API, so
+    a saved result is found without cloning the repo. A check that is run is run against these exact commits.
+    :param api_url: The Gitea API URL of the base repo
+    :param commits: The commits returned by get_commits()
+    :return: The cache key, or None if the base repo has no check files
+    """
+    key = hashlib.sha256()
+    for commit in [commits['default'], commits['base'], commits['head']]:
+        key.update(commit.encode('utf-8'))
+
+    for check_file in ['check.js', 'package.json', 'package-lock.json']:
+        try:
+            contents = gitea_request(api_url + '/raw/' + check_file + '?ref=' + commits['default'])
+        except urllib.error.HTTPError as ex:
+            if ex.code != 404:
+                raise
+            # The lock file is optional, but there is nothing to check without the others
+            if check_file != 'package-lock.json':
+                return None
+            contents = b''
+        key.update(hashlib.sha256(contents).digest())
+
+    return key.hexdigest()
+
+
+def install_dependencies():
+    """
+    Makes the dependencies of check.js available in the node_modules directory. Installed dependencies are saved in a
+    directory keyed by the hash of package.json and package-lock.json, and later runs with the same files link to
+    the saved directory instead of installing the dependencies again. npm also keeps its download cache between runs.
+    :return: The npm exit code, or 0 if saved dependencies were used
+    """
+    key = hashlib.sha256()
+    for dependency_file in ['package.json', 'package-lock.json']:
+        key.update(Path(dependency_file).read_bytes() if os.path.exists(dependency_file) else b'')
+
+    cached_modules_dir = os.path.join(node_modules_cache_dir, key.hexdigest())
+
+    if os.path.isdir(os.path.join(cached_modules_dir, 'node_modules')):
+        print('Using dependencies saved by a previous check')
+    else:
+        # Dependencies are installed into a staging directory that is renamed once complete, so a failed or
+        # concurrent install never leaves a partial directory behind
+        staging_dir = tempfile.mkdtemp(dir=node_modules_cache_dir)
+        try:
+            for dependency_file in ['package.json', 'package-lock.json']:
+                if os.path.exists(dependency_file):
+                    shutil.copy2(dependency_file, staging_dir)
+
+            npm_command = 'ci' if os.path.exists('package-lock.json') else 'install'
+            _, _, retcode = execute(['npm', npm_command, '--prefer-offline', '--no-audit', '--no-fund',
+                                     '--cache', npm_cache_dir], staging_dir)
+            if retcode != 0:
+                return retcode
+
+            # npm does not create node_modules when there are no dependencies
+            os.makedirs(os.path.join(staging_dir, 'node_modules'), exist_ok=True)
+
+            # The rename fails if a concurrent check saved the same dependencies first, which are used instead
+            with contextlib.suppress(OSError):
+                os.rename(staging_dir, cached_modules_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        if not os.path.isdir(os.path.join(cached_modules_dir, 'node_modules')):
+            print('Failed to save the dependencies to ' + cached_modules_dir)
+            return 1
+
+    os.symlink(os.path.join(cached_modules_dir, 'node_modules'), 'node_modules')
+    return 0
+
+
+def copy_check_files():
+    """
+    Copies the check files out of the main branch checked out in the clone directory.
+    """
+    for check_file in ['check.js', 'package.json', 'package-lock.json']:
+        if os.path.exists('clone/' + check_file):
+            shutil.copy2('clone/' + check_file, '.')
+
+
+def clone_merge_result(base_repo_url, pr):
+    """
+    Clones the base repo, copies the check files, and merges the PR branch into the base branch.
+    :param base_repo_url: The URL of the base repo
+    :param pr: The pull request from the webhook body
+    """
+    # Clone the base repo
+    execute(['git', 'clone', base_repo_url, '.'], 'clone')
+
+    copy_check_files()
+
+    # Checkout the branch being merged, and initiate the merge
+    execute(['git', 'checkout', '-b', pr['pull_request']['head']['ref'], pr['pull_request']['base']['ref']], 'clone')
+    execute(['git', 'pull', 'origin', pr['pull_request']['head']['ref']], 'clone')
+    execute(['git', 'checkout', pr['pull_request']['base']['ref']], 'clone')
+    execute(['git', 'merge', '--no-ff', '--no-edit', pr['pull_request']['head']['ref']], 'clone')
+
+
+def fetch_merge_result(base_repo_url, pr, commits):
+    """
+    Produces the same result as clone_merge_result() with a minimal fetch. Only the commits in the cache key are
+    fetched, and file contents are left out of the fetch. The merge is computed from the trees without a working copy,
+    and only the files read by the check are checked out, so only their contents are downloaded. The history is not
+    truncated, as the merge base must be found.
+    :param base_repo_url: The URL of the base repo
+    :param pr: The pull request from the webhook body
+    :param commits: The commits returned by get_commits()
+    :return: True if the merge result was checked out, and False if the minimal fetch is not supported
+    """
+    head_ref = pr['pull_request']['head']['ref']
+
+    execute(['git', 'init', '-q', '.'], 'clone')
+    execute(['git', 'remote', 'add', 'origin', base_repo_url], 'clone')
+    _, _, retcode = execute(['git', 'fetch', '--filter=blob:none', '--no-tags', 'origin'] +
+                            list(dict.fromkeys([commits['default'], commits['base'], commits['head']])), 'clone')
+    if retcode != 0:
+        return False
+
+    execute(['git', 'sparse-checkout', 'set', '--no-cone', '/.octopus/project/', '/check.js', '/package.json',
+             '/package-lock.json'], 'clone')
+    _, _, retcode = execute(['git', 'checkout', '-q', '--detach', commits['default']], 'clone')
+    if retcode != 0:
+        return False
+
+    copy_check_files()
+
+    # A merge with conflicts still writes a tree, with conflict markers in the conflicting files
+    stdout, _, retcode = execute(['git', 'merge-tree', '--write-tree', '--no-messages',
+                                  commits['base'], commits['head']], 'clone')
+    if retcode not in [0, 1]:
+        return False
+
+    merge_commit, _, retcode = execute(['git', 'commit-tree', stdout.splitlines()[0],
+                                        '-p', commits['base'], '-p', commits['head'],
+                                        '-m', "Merge branch '" + head_ref + "'"], 'clone')
+    if retcode != 0:
+        return False
+
+    _, _, retcode = execute(['git', 'checkout', '-q', '--detach', merge_commit.strip()], 'clone')
+    return retcode == 0
+
+
+# Check results are saved between runs, so re-delivered webhooks and re-runs for the same commits post the saved
+# result rather than running the check again
+cache_dir = os.path.join(tempfile.gettempdir(), 'octopus_pr_check_cache')
+# The dependencies of check.js and the npm download cache are also kept between runs
+node_modules_cache_dir = os.path.join(tempfile.gettempdir(), 'octopus_pr_check_node_modules')
+npm_cache_dir = os.path.join(tempfile.gettempdir(), 'octopus_npm_cache')
+
 try:
     # Some dummy values expected by git.
     execute(['git', 'config', '--global', 'user.email', 'octopus@octopus.com'])
@@ -46,47 +252,78 @@ try:
 
     base_repo = pr['pull_request']['base']['repo']['clone_url']
 
-    # Clean up any existing clones
-    if os.path.exists('clone'):
-        shutil.rmtree('clone')
+    # Gitea thinks it is hosted on localhost, but we know it is hosted on "gitea"
+    parsedUrl = urlparse(pr['pull_request']['url'])
+    baseUrl = parsedUrl.scheme + '://gitea:' + str(parsedUrl.port)
+    repo_api_url = baseUrl + '/api/v1/repos/' + pr['pull_request']['base']['repo']['full_name']
 
-    # This is the directory the PR is cloned into
-    os.mkdir('clone')
+    # The caches are kept in the shared temp directory, so they are only accessible to the current user. This also
+    # applies to directories created by earlier runs, and fails if they are owned by another user.
+    for private_dir in [cache_dir, node_modules_cache_dir, npm_cache_dir]:
+        os.makedirs(private_dir, mode=0o700, exist_ok=True)
+        os.chmod(private_dir, 0o700)
 
-    # Clone the base repo
-    execute(['git', 'clone', base_repo.replace('localhost', 'gitea'), '.'], 'clone')
+    base_repo_url = base_repo.replace('localhost', 'gitea')
 
-    # We expect to find a file called check.js (and its associated package.json file).
-    # If not, there is nothing to check
-    if not os.path.exists('clone/check.js') or not os.path.exists('clone/package.json'):
-        print('No check.js file in the main branch')
-        sys.exit(0)
+    # A saved result is posted without cloning the repo or installing dependencies
+    cache_key = None
+    commits = get_commits(base_repo_url, pr)
+    if commits is None:
+        print('Failed to find the branches of the PR, the check result will not be cached')
+    else:
+        try:
+            cache_key = get_cache_key(repo_api_url, commits)
+            if cache_key is None:
+                print('No check.js file in the main branch')
+                sys.exit(0)
+        except (urllib.error.URLError, ValueError) as ex:
+            print('Failed to read the check files from the Gitea API, the check result will not be cached: ' + str(ex))
 
-    # Copy the check files out of the main branch
-    shutil.copy2('clone/check.js', '.')
-    shutil.copy2('clone/package.json', '.')
+    cache_file = os.path.join(cache_dir, cache_key + '.json') if cache_key is not None else None
 
-    # Checkout the branch being merged, and initiate the merge
-    execute(['git', 'checkout', '-b', pr['pull_request']['head']['ref'], pr['pull_request']['base']['ref']], 'clone')
-    execute(['git', 'pull', 'origin', pr['pull_request']['head']['ref']], 'clone')
-    execute(['git', 'checkout', pr['pull_request']['base']['ref']], 'clone')
-    execute(['git', 'merge', '--no-ff', '--no-edit', pr['pull_request']['head']['ref']], 'clone')
+    if cache_file is not None and os.path.exists(cache_file):
+        print('Using the result of a previous check of the same commits')
+        result = json.loads(Path(cache_file).read_text())
+        stdout, retcode = result['description'], result['retcode']
+    else:
+        # Clean up any existing clones
+        if os.path.exists('clone'):
+            shutil.rmtree('clone')
 
-    # Install the check file dependencies and run the check
-    execute(['npm', 'install'])
-    stdout, stderr, retcode = execute(['node', 'check.js', 'clone/.octopus/project'])
+        # This is the directory the PR is cloned into
+        os.mkdir('clone')
 
-    # This is the result of the check
-    print(stdout)
-    print(stderr)
+        if commits is None or not fetch_merge_result(base_repo_url, pr, commits):
+            # The full clone checks out the branches by name, which may have moved since the cache key was built, so
+            # its result is not saved
+            print('Failed to fetch the merge result with a partial clone, falling back to a full clone')
+            cache_file = None
+            shutil.rmtree('clone')
+            os.mkdir('clone')
+            clone_merge_result(base_repo_url, pr)
 
-    # Gitea thinks it is hosted on localhost, but we know it is hosted on "gitea"
-    parsedUrl = urlparse(pr['pull_request']['url'])
-    baseUrl = parsedUrl.scheme + '://gitea:' + str(parsedUrl.port)
+        # We expect to find a file called check.js (and its associated package.json file).
+        # If not, there is nothing to check
+        if not os.path.exists('check.js') or not os.path.exists('package.json'):
+            print('No check.js file in the main branch')
+            sys.exit(0)
+
+        # Install the check file dependencies and run the check
+        npm_retcode = install_dependencies()
+        stdout, stderr, retcode = execute(['node', 'check.js', 'clone/.octopus/project'])
+
+        # This is the result of the check
+        print(stdout)
+        print(stderr)
+
+        # A failure to install the dependencies says nothing about the PR, so the result is not saved
+        if cache_file is not None and npm_retcode == 0:
+            with open(cache_file + '.tmp', 'w') as f:
+                json.dump({'description': stdout, 'retcode': retcode}, f)
+            os.replace(cache_file + '.tmp', cache_file)
 
     # Post the check results back to Gitea
-    url = baseUrl + '/api/v1/repos/' + pr['pull_request']['base']['repo']['full_name'] + "/statuses/" + \
-          pr['pull_request']['head']['sha']
+    url = repo_api_url + "/statuses/" + pr['pull_request']['head']['sha']
     runbook_url = "http://localhost:18080/app#/Spaces-1/projects/pr-checks/operations/runbooks/" + \
                   get_octopusvariable("Octopus.Runbook.Id") + \
                   "/snapshots/" + \
@@ -97,28 +334,20 @@ try:
 
     status = {"context": "octopus", "description": stdout, "state": "success" if retcode == 0 else "failure",
               "target_url": runbook_url}
-    status_string = json.dumps(status)
 
-    auth = base64.b64encode("octopus:Password01!".encode('ascii'))
-    auth_header = "Basic " + auth.decode('ascii')
-
-    headers = {
-        "Authorization": auth_header,
-        "Content-Type": "application/json"
-    }
-
-    request = urllib.request.Request(url, headers=headers, data=status_string.encode('utf-8'))
-    with urllib.request.urlopen(request) as response:
-        data = json.loads(response.read().decode("utf-8"))
-        print("##octopus[stdout-verbose]")
-        print(data)
-        print("##octopus[stdout-default]")
+    data = json.loads(gitea_request(url, status).decode("utf-8"))
+    print("##octopus[stdout-verbose]")
+    print(data)
+    print("##octopus[stdout-default]")
 
 finally:
-    # Clean everything up
+    # Clean everything up. node_modules is usually a link to the saved dependencies, which are kept.
     with contextlib.suppress(FileNotFoundError):
         shutil.rmtree('clone')
+    if os.path.islink('node_modules'):
+        os.remove('node_modules')
+    elif os.path.exists('node_modules'):
         shutil.rmtree('node_modules')
-        os.remove('check.js')
-        os.remove('package.json')
-        os.remove('package-lock.json')
+    for check_file in ['check.js', 'package.json', 'package-lock.json']:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(check_file)
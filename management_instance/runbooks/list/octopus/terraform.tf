@@ -175,7 +175,7 @@ EOT
       properties                         = {
         "Octopus.Action.Script.ScriptSource" = "Inline"
         "Octopus.Action.Script.Syntax"       = "Python"
-        "Octopus.Action.Script.ScriptBody"   = file("../../shared_scripts/list_downstream_projects.py")
+        "Octopus.Action.Script.ScriptBody"   = join("\n", [file("../../shared_scripts/runbook_helpers.py"), file("../../shared_scripts/list_downstream_projects.py")])
         "OctopusUseBundledTooling" = "False"
       }
 
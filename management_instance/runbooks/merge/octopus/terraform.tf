@@ -109,7 +109,7 @@ resource "octopusdeploy_runbook_process" "runbook_process_merge_git" {
       properties                         = {
         "Octopus.Action.Script.ScriptSource" = "Inline"
         "Octopus.Action.Script.Syntax"       = "Python"
-        "Octopus.Action.Script.ScriptBody"   = file("../../shared_scripts/merge_repo.py")
+        "Octopus.Action.Script.ScriptBody"   = join("\n", [file("../../shared_scripts/runbook_helpers.py"), file("../../shared_scripts/merge_repo.py")])
         "OctopusUseBundledTooling" = "False"
       }
 
@@ -169,7 +169,7 @@ resource "octopusdeploy_runbook_process" "runbook_process_merge_all_git" {
       properties                         = {
         "Octopus.Action.Script.ScriptSource" = "Inline"
         "Octopus.Action.Script.Syntax"       = "Python"
-        "Octopus.Action.Script.ScriptBody"   = file("../../shared_scripts/merge_all_downstream_projects.py")
+        "Octopus.Action.Script.ScriptBody"   = join("\n", [file("../../shared_scripts/runbook_helpers.py"), file("../../shared_scripts/merge_all_downstream_projects.py")])
         "OctopusUseBundledTooling" = "False"
       }
 
@@ -0,0 +1,193 @@
+terraform {
+  required_providers {
+    octopusdeploy = { source = "OctopusDeployLabs/octopusdeploy", version = "0.12.7" }
+  }
+}
+
+locals {
+  backend = "#{Octopus.Project.Name | ToLower | Replace \"[^a-zA-Z0-9]\" \"_\"}"
+}
+
+variable "project_name" {
+  type        = string
+  nullable    = false
+  sensitive   = false
+  description = "The name of the project to attach the runbooks to."
+}
+
+data "octopusdeploy_worker_pools" "workerpool_default" {
+  name = "Default Worker Pool"
+  ids  = null
+  skip = 0
+  take = 1
+}
+
+data "octopusdeploy_feeds" "feed_octopus_server__built_in_" {
+  feed_type    = "BuiltIn"
+  ids          = null
+  partial_name = ""
+  skip         = 0
+  take         = 1
+}
+
+data "octopusdeploy_feeds" "feed_docker" {
+  feed_type    = "Docker"
+  ids          = null
+  partial_name = "Docker"
+  skip         = 0
+  take         = 1
+}
+
+data "octopusdeploy_projects" "project" {
+  cloned_from_project_id = null
+  ids                    = []
+  is_clone               = false
+  name                   = var.project_name
+  partial_name           = null
+  skip                   = 0
+  take                   = 1
+}
+
+data "octopusdeploy_environments" "sync" {
+  ids          = []
+  partial_name = "Sync"
+  skip         = 0
+  take         = 1
+}
+
+variable "runbook_scan_downstream_projects_name" {
+  type        = string
+  nullable    = false
+  sensitive   = false
+  description = "The name of the runbook that scans the downstream projects"
+  default     = "__ 7. Scan Downstream Projects"
+}
+
+resource "octopusdeploy_runbook" "runbook_scan_downstream_projects" {
+  name                        = var.runbook_scan_downstream_projects_name
+  project_id                  = data.octopusdeploy_projects.project.projects[0].id
+  environment_scope           = "Specified"
+  environments                = [data.octopusdeploy_environments.sync.environments[0].id]
+  force_package_download      = false
+  default_guided_failure_mode = "EnvironmentDefault"
+  description                 = "This project checks the deployment process of all the downstream projects created from this upstream template against the policy defined in check.js."
+  multi_tenancy_mode          = "Untenanted"
+
+  retention_policy {
+    quantity_to_keep    = 100
+    should_keep_forever = false
+  }
+
+  connectivity_policy {
+    allow_deployments_to_no_targets = true
+    exclude_unhealthy_targets       = false
+    skip_machine_behavior           = "None"
+  }
+}
+
+resource "octopusdeploy_runbook_process" "runbook_process_scan_downstream_projects" {
+  runbook_id = octopusdeploy_runbook.runbook_scan_downstream_projects.id
+
+  step {
+    condition           = "Success"
+    name                = "Create the State Table"
+    package_requirement = "LetOctopusDecide"
+    start_trigger       = "StartAfterPrevious"
+
+    action {
+      action_type                        = "Octopus.Script"
+      name                               = "Create the State Table"
+      condition                          = "Success"
+      run_on_server                      = true
+      is_disabled                        = false
+      can_be_used_for_project_versioning = false
+      is_required                        = false
+      worker_pool_id                     = data.octopusdeploy_worker_pools.workerpool_default.worker_pools[0].id
+      properties                         = {
+        "Octopus.Action.Script.ScriptSource" = "Inline"
+        "Octopus.Action.Script.Syntax"       = "Bash"
+        "Octopus.Action.Script.ScriptBody"   = <<EOT
+echo "Verify Docker is Running"
+echo "##octopus[stdout-verbose]"
+docker info
+if ! docker info
+then
+  echo "Docker is not running. Check that Docker is installed and the daemon is running."
+  exit 1
+fi
+echo "##octopus[stdout-default]"
+
+echo "Pulling postgres image"
+echo "##octopus[stdout-verbose]"
+max_retry=12
+counter=0
+until /usr/bin/flock /tmp/dockerpull.lock docker pull postgres 2>&1
+do
+   sleep 5
+   [[ counter -eq $max_retry ]] && echo "Failed!" && exit 1
+   echo "Trying again. Try #$counter"
+   ((counter++))
+done
+echo "##octopus[stdout-default]"
+DATABASE=$(dig +short terraformdb)
+
+# Creating databases can lead to race conditions in Postrges. We use flock to try and reduce the chances, and then
+# a retry loop to ensure the command succeeds successfully.
+max_retry=2
+counter=0
+until /usr/bin/flock /tmp/${local.backend}.lock docker run --rm -e "PGPASSWORD=terraform" --entrypoint '/bin/bash' postgres -c "echo \"SELECT 'CREATE DATABASE ${local.backend}' WHERE NOT EXISTS (SELECT FROM pg_database WHERE datname = '${local.backend}')\gexec\" | /usr/bin/psql -h $${DATABASE} -v ON_ERROR_STOP=1 --username 'terraform'" 2>&1
+do
+   sleep 5
+   [[ counter -eq $max_retry ]] && echo "Failed!" && exit 1
+   echo "Trying again. Try #$counter"
+   ((counter++))
+done
+
+exit 0
+EOT
+      }
+      environments          = []
+      excluded_environments = []
+      channels              = []
+      tenant_tags           = []
+      features              = []
+    }
+
+    properties   = {}
+    target_roles = []
+  }
+
+  step {
+    condition           = "Success"
+    name                = "Scan Downstream Projects"
+    package_requirement = "LetOctopusDecide"
+    start_trigger       = "StartAfterPrevious"
+
+    action {
+      action_type                        = "Octopus.Script"
+      name                               = "Scan Downstream Projects"
+      condition                          = "Success"
+      run_on_server                      = true
+      is_disabled                        = false
+      can_be_used_for_project_versioning = true
+      is_required                        = false
+      worker_pool_id                     = data.octopusdeploy_worker_pools.workerpool_default.worker_pools[0].id
+      properties                         = {
+        "Octopus.Action.Script.ScriptSource" = "Inline"
+        "Octopus.Action.Script.Syntax"       = "Python"
+        "Octopus.Action.Script.ScriptBody"   = join("\n", [file("../../shared_scripts/runbook_helpers.py"), file("../../shared_scripts/scan_downstream_projects.py")])
+        "OctopusUseBundledTooling" = "False"
+      }
+
+      environments          = []
+      excluded_environments = []
+      channels              = []
+      tenant_tags           = []
+      features              = []
+    }
+
+    properties   = {}
+    target_roles = []
+  }
+}
+
@@ -132,7 +132,7 @@ resource "octopusdeploy_runbook_process" "runbook_process_backend_service_serial
       worker_pool_id                     = data.octopusdeploy_worker_pools.workerpool_default.worker_pools[0].id
       properties                         = {
         "Octopus.Action.Script.Syntax"       = "Python"
-        "Octopus.Action.Script.ScriptBody"   = file("../../shared_scripts/serialize_project.py")
+        "Octopus.Action.Script.ScriptBody"   = join("\n", [file("../../shared_scripts/runbook_helpers.py"), file("../../shared_scripts/serialize_project.py")])
         "Octopus.Action.Script.ScriptSource" = "Inline"
       }
       environments          = []
@@ -472,7 +472,7 @@ resource "octopusdeploy_runbook_process" "runbook_process_backend_service_deploy
       worker_pool_id                     = data.octopusdeploy_worker_pools.workerpool_default.worker_pools[0].id
       properties                         = {
         "Octopus.Action.Script.Syntax"       = "Python"
-        "Octopus.Action.Script.ScriptBody"   = file("../../shared_scripts/apply_all_downstream_projects.py")
+        "Octopus.Action.Script.ScriptBody"   = join("\n", [file("../../shared_scripts/runbook_helpers.py"), file("../../shared_scripts/apply_all_downstream_projects.py")])
         "Octopus.Action.Script.ScriptSource" = "Inline"
       }
       environments          = []
@@ -1,67 +1,14 @@
 import json
-import subprocess
 import sys
 import os
 import urllib.request
 import base64
-import re
 import argparse
 
-# If this script is not being run as part of an Octopus step, return variables from environment variables.
-# Periods are replaced with underscores, and the variable name is converted to uppercase
-if "get_octopusvariable" not in globals():
-    def get_octopusvariable(variable):
-        return os.environ[re.sub('\\.', '_', variable.upper())]
-
-# If this script is not being run as part of an Octopus step, print directly to std out.
-if "printverbose" not in globals():
-    def printverbose(msg):
-        print(msg)
-
-
-def printverbose_noansi(output):
-    """
-    Strip ANSI color codes and print the output as verbose
-    :param output: The output to print
-    """
-    output_no_ansi = re.sub('\x1b\[[0-9;]*m', '', output)
-    printverbose(output_no_ansi)
-
-
-def get_octopusvariable_quiet(variable):
-    """
-    Gets an octopus variable, or an empty string if it does not exist.
-    :param variable: The variable name
-    :return: The variable value, or an empty string if the variable does not exist
-    """
-    try:
-        return get_octopusvariable(variable)
-    except:
-        return ''
-
-
-def execute(args, cwd=None, env=None, print_args=None, print_output=printverbose_noansi):
-    """
-        The execute method provides the ability to execute external processes while capturing and returning the
-        output to std err and std out and exit code.
-    """
-    process = subprocess.Popen(args,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               text=True,
-                               cwd=cwd,
-                               env=env)
-    stdout, stderr = process.communicate()
-    retcode = process.returncode
-
-    if print_args is not None:
-        print_output(' '.join(args))
-
-    if print_output is not None:
-        print_output(stdout)
-        print_output(stderr)
-
-    return stdout, stderr, retcode
+# Octopus steps prepend the shared helpers to this script. When the script is run directly, they are imported
+# from runbook_helpers.py in the same directory.
+if "execute" not in globals():
+    from runbook_helpers import *
 
 
 def init_argparse():
@@ -126,14 +73,14 @@ def init_argparse():
 
 parser, _ = init_argparse()
 
-tenant_name_sanitized = re.sub('[^a-zA-Z0-9]', '_', get_octopusvariable_quiet('Octopus.Deployment.Tenant.Name').lower())
-new_project_name_sanitized = re.sub('[^a-zA-Z0-9]', '_', get_octopusvariable_quiet('Exported.Project.Name').lower())
-original_project_name_sanitized = re.sub('[^a-zA-Z0-9]', '_', get_octopusvariable_quiet('Octopus.Project.Name').lower())
+tenant_name_sanitized = NON_ALPHANUMERIC_RE.sub('_', get_octopusvariable_quiet('Octopus.Deployment.Tenant.Name').lower())
+new_project_name_sanitized = NON_ALPHANUMERIC_RE.sub('_', get_octopusvariable_quiet('Exported.Project.Name').lower())
+original_project_name_sanitized = NON_ALPHANUMERIC_RE.sub('_', get_octopusvariable_quiet('Octopus.Project.Name').lower())
 project_name_sanitized = new_project_name_sanitized if len(new_project_name_sanitized) != 0 \
     else original_project_name_sanitized
 new_repo = parser.new_repo or tenant_name_sanitized + '_' + project_name_sanitized
-template_repo = parser.template_repo or re.sub('[^a-zA-Z0-9]', '_',
-                                               get_octopusvariable_quiet('Octopus.Project.Name').lower())
+template_repo = parser.template_repo or NON_ALPHANUMERIC_RE.sub(
+    '_', get_octopusvariable_quiet('Octopus.Project.Name').lower())
 branch = parser.mainline_branch or 'main'
 
 # Attempt to view the template repo
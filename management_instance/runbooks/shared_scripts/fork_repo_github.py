@@ -1,88 +1,30 @@
 # This script forks a GitHub repo. It creates a token from a GitHub App installation to avoid
 # having to use a regular user account.
-import subprocess
 import sys
 
-# Install our own dependencies
-subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'jwt'])
-
 import json
-import subprocess
 import sys
 import os
 import urllib.request
 import base64
 import re
-import jwt
-import time
+import tempfile
 import argparse
 import platform
 from urllib.request import urlretrieve
 
+# Octopus steps prepend the shared helpers to this script. When the script is run directly, they are imported
+# from runbook_helpers.py in the same directory.
+if "execute" not in globals():
+    from runbook_helpers import *
+
+NON_ALPHANUMERIC_OR_DASH_RE = re.compile('[^a-zA-Z0-9-]')
+
 # If this script is not being run as part of an Octopus step, setting variables is a noop
 if 'set_octopusvariable' not in globals():
     def set_octopusvariable(variable, value):
         pass
 
-# If this script is not being run as part of an Octopus step, return variables from environment variables.
-# Periods are replaced with underscores, and the variable name is converted to uppercase
-if "get_octopusvariable" not in globals():
-    def get_octopusvariable(variable):
-        return os.environ[re.sub('\\.', '_', variable.upper())]
-
-# If this script is not being run as part of an Octopus step, print directly to std out.
-if 'printverbose' not in globals():
-    def printverbose(msg):
-        print(msg)
-
-
-def printverbose_noansi(output):
-    """
-    Strip ANSI color codes and print the output as verbose
-    :param output: The output to print
-    """
-    output_no_ansi = re.sub('\x1b\[[0-9;]*m', '', output)
-    printverbose(output_no_ansi)
-
-
-def get_octopusvariable_quiet(variable):
-    """
-    Gets an octopus variable, or an empty string if it does not exist.
-    :param variable: The variable name
-    :return: The variable value, or an empty string if the variable does not exist
-    """
-    try:
-        return get_octopusvariable(variable)
-    except:
-        return ''
-
-
-def execute(args, cwd=None, env=None, print_args=None, print_output=printverbose_noansi, raise_on_non_zero=False):
-    """
-        The execute method provides the ability to execute external processes while capturing and returning the
-        output to std err and std out and exit code.
-    """
-    process = subprocess.Popen(args,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               text=True,
-                               cwd=cwd,
-                               env=env)
-    stdout, stderr = process.communicate()
-    retcode = process.returncode
-
-    if not retcode == 0 and raise_on_non_zero:
-        raise Exception('command returned exit code ' + retcode)
-
-    if print_args is not None:
-        print_output(' '.join(args))
-
-    if print_output is not None:
-        print_output(stdout)
-        print_output(stderr)
-
-    return stdout, stderr, retcode
-
 
 def init_argparse():
     parser = argparse.ArgumentParser(
@@ -100,7 +42,7 @@ def init_argparse():
     parser.add_argument('--template-repo-name', action='store',
                         default=get_octopusvariable_quiet(
                             'ForkGithubRepo.Git.Url.OriginalRepoName') or
-                                re.sub('[^a-zA-Z0-9-]', '_', get_octopusvariable_quiet('Octopus.Project.Name')))
+                                NON_ALPHANUMERIC_OR_DASH_RE.sub('_', get_octopusvariable_quiet('Octopus.Project.Name')))
     parser.add_argument('--tenant-name', action='store',
                         default=get_octopusvariable_quiet('Octopus.Deployment.Tenant.Name'))
     parser.add_argument('--git-organization', action='store',
@@ -128,40 +70,15 @@ def init_argparse():
                             'GitHub.Credentials.AccessToken'),
                         help='The GitHub access token. This takes precedence over the --github-app-id,  --github-app-installation-id, and --github-app-private-key')
 
+    parser.add_argument('--github-token-cache-dir', action='store',
+                        default=get_octopusvariable_quiet('GitHub.Token.Cache.Directory') or get_octopusvariable_quiet(
+                            'ForkGithubRepo.GitHub.Token.Cache.Directory') or os.path.join(
+                            tempfile.gettempdir(), 'octopus_github_tokens'),
+                        help='The directory holding the GitHub App installation tokens, which are reused until they '
+                             'are about to expire')
     return parser.parse_known_args()
 
 
-def generate_github_token(github_app_id, github_app_private_key, github_app_installation_id):
-    # Generate the tokens used by git and the GitHub API
-    app_id = github_app_id
-    signing_key = jwt.jwk_from_pem(github_app_private_key.encode('utf-8'))
-
-    payload = {
-        # Issued at time
-        'iat': int(time.time()),
-        # JWT expiration time (10 minutes maximum)
-        'exp': int(time.time()) + 600,
-        # GitHub App's identifier
-        'iss': app_id
-    }
-
-    # Create JWT
-    jwt_instance = jwt.JWT()
-    encoded_jwt = jwt_instance.encode(payload, signing_key, alg='RS256')
-
-    # Create access token
-    url = 'https://api.github.com/app/installations/' + github_app_installation_id + '/access_tokens'
-    headers = {
-        'Authorization': 'Bearer ' + encoded_jwt,
-        'Accept': 'application/vnd.github+json',
-        'X-GitHub-Api-Version': '2022-11-28'
-    }
-    request = urllib.request.Request(url, headers=headers, method='POST')
-    response = urllib.request.urlopen(request)
-    response_json = json.loads(response.read().decode())
-    return response_json['token']
-
-
 def generate_auth_header(token):
     auth = base64.b64encode(('x-access-token:' + token).encode('ascii'))
     return 'Basic ' + auth.decode('ascii')
@@ -333,8 +250,8 @@ if not parser.tenant_name.strip() and not parser.new_repo_name_prefix.strip():
     sys.exit(1)
 
 # The access token is generated from a github app or supplied directly as an access token
-token = generate_github_token(parser.github_app_id, parser.github_app_private_key,
-                              parser.github_app_installation_id) if len(
+token = get_github_token(parser.github_app_id, parser.github_app_private_key, parser.github_app_installation_id,
+                         parser.github_token_cache_dir) if len(
     parser.github_access_token.strip()) == 0 else parser.github_access_token.strip()
 
 # The process followed here is:
@@ -347,10 +264,10 @@ token = generate_github_token(parser.github_app_id, parser.github_app_private_ke
 
 cac_org = parser.git_organization.strip()
 template_repo = parser.template_repo_name.strip()
-new_repo_custom_prefix = re.sub('[^a-zA-Z0-9-]', '_', parser.new_repo_name_prefix.strip())
-tenant_name_sanitized = re.sub('[^a-zA-Z0-9-]', '_', parser.tenant_name.strip())
-project_repo_sanitized = re.sub('[^a-zA-Z0-9-]', '_',
-                                parser.new_repo_name.strip() if parser.new_repo_name.strip() else template_repo)
+new_repo_custom_prefix = NON_ALPHANUMERIC_OR_DASH_RE.sub('_', parser.new_repo_name_prefix.strip())
+tenant_name_sanitized = NON_ALPHANUMERIC_OR_DASH_RE.sub('_', parser.tenant_name.strip())
+project_repo_sanitized = NON_ALPHANUMERIC_OR_DASH_RE.sub(
+    '_', parser.new_repo_name.strip() if parser.new_repo_name.strip() else template_repo)
 
 # The new repo is prefixed either with the custom prefix or the tenant name if no custom prefix is defined
 new_repo_prefix = new_repo_custom_prefix if len(new_repo_custom_prefix) != 0 else tenant_name_sanitized
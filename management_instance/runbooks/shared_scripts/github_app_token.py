@@ -1,41 +1,17 @@
-import sys
-import subprocess
-
-# Install our own dependencies
-subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'jwt'])
-
 import argparse
-import json
 import os
-import time
-import urllib.request
-import re
+import tempfile
 
-import jwt
+# Octopus steps prepend the shared helpers to this script. When the script is run directly, they are imported
+# from runbook_helpers.py in the same directory.
+if "execute" not in globals():
+    from runbook_helpers import *
 
 # If this script is not being run as part of an Octopus step, setting variables is a noop
 if 'set_octopusvariable' not in globals():
     def set_octopusvariable(variable, value):
         pass
 
-# If this script is not being run as part of an Octopus step, return variables from environment variables.
-# Periods are replaced with underscores, and the variable name is converted to uppercase
-if "get_octopusvariable" not in globals():
-    def get_octopusvariable(variable):
-        return os.environ[re.sub('\\.', '_', variable.upper())]
-
-
-def get_octopusvariable_quiet(variable):
-    """
-    Gets an octopus variable, or an empty string if it does not exist.
-    :param variable: The variable name
-    :return: The variable value, or an empty string if the variable does not exist
-    """
-    try:
-        return get_octopusvariable(variable)
-    except:
-        return ''
-
 
 def init_argparse():
     parser = argparse.ArgumentParser(
@@ -55,38 +31,21 @@ def init_argparse():
                         default=get_octopusvariable_quiet('GitHub.App.PrivateKey') or get_octopusvariable_quiet(
                             'GitHubAppToken.GitHub.App.PrivateKey'))
 
+    parser.add_argument('--github-token-cache-dir',
+                        action='store',
+                        default=get_octopusvariable_quiet('GitHub.Token.Cache.Directory') or get_octopusvariable_quiet(
+                            'GitHubAppToken.GitHub.Token.Cache.Directory') or os.path.join(tempfile.gettempdir(),
+                                                                                           'octopus_github_tokens'),
+                        help='The directory holding the GitHub App installation tokens, which are reused until they '
+                             'are about to expire')
+
     return parser.parse_known_args()
 
 
 parser, _ = init_argparse()
 
 # Generate the tokens used by git and the GitHub API
-app_id = parser.github_app_id
-signing_key = jwt.jwk_from_pem(parser.github_app_private_key.encode('utf-8'))
-
-payload = {
-    # Issued at time
-    'iat': int(time.time()),
-    # JWT expiration time (10 minutes maximum)
-    'exp': int(time.time()) + 600,
-    # GitHub App's identifier
-    'iss': app_id
-}
-
-# Create JWT
-jwt_instance = jwt.JWT()
-encoded_jwt = jwt_instance.encode(payload, signing_key, alg='RS256')
-
-# Create access token
-url = 'https://api.github.com/app/installations/' + parser.github_app_installation_id + '/access_tokens'
-headers = {
-    'Authorization': 'Bearer ' + encoded_jwt,
-    'Accept': 'application/vnd.github+json',
-    'X-GitHub-Api-Version': '2022-11-28'
-}
-request = urllib.request.Request(url, headers=headers, method='POST')
-response = urllib.request.urlopen(request)
-response_json = json.loads(response.read().decode())
-token = response_json['token']
+token = get_github_token(parser.github_app_id, parser.github_app_private_key, parser.github_app_installation_id,
+                         parser.github_token_cache_dir)
 
 set_octopusvariable('GitHubToken', token)
@@ -1,71 +1,19 @@
 import argparse
-import subprocess
 import sys
 import os
+import tempfile
 import urllib.request
 import base64
-import re
 
-# If this script is not being run as part of an Octopus step, print directly to std out.
-if "printverbose" not in globals():
-    def printverbose(msg):
-        print(msg)
+# Octopus steps prepend the shared helpers to this script. When the script is run directly, they are imported
+# from runbook_helpers.py in the same directory.
+if "execute" not in globals():
+    from runbook_helpers import *
 
 if "printhighlight" not in globals():
     def printhighlight(msg):
         print(msg)
 
-# If this script is not being run as part of an Octopus step, return variables from environment variables.
-# Periods are replaced with underscores, and the variable name is converted to uppercase
-if "get_octopusvariable" not in globals():
-    def get_octopusvariable(variable):
-        return os.environ[re.sub('\\.', '_', variable.upper())]
-
-
-def get_octopusvariable_quiet(variable):
-    """
-    Gets an octopus variable, or an empty string if it does not exist.
-    :param variable: The variable name
-    :return: The variable value, or an empty string if the variable does not exist
-    """
-    try:
-        return get_octopusvariable(variable)
-    except:
-        return ''
-
-
-def printverbose_noansi(output):
-    """
-    Strip ANSI color codes and print the output as verbose
-    :param output: The output to print
-    """
-    output_no_ansi = re.sub('\x1b\[[0-9;]*m', '', output)
-    printverbose(output_no_ansi)
-
-
-def execute(args, cwd=None, env=None, print_args=None, print_output=printverbose_noansi):
-    """
-        The execute method provides the ability to execute external processes while capturing and returning the
-        output to std err and std out and exit code.
-    """
-    process = subprocess.Popen(args,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               text=True,
-                               cwd=cwd,
-                               env=env)
-    stdout, stderr = process.communicate()
-    retcode = process.returncode
-
-    if print_args is not None:
-        print_output(' '.join(args))
-
-    if print_output is not None:
-        print_output(stdout)
-        print_output(stderr)
-
-    return stdout, stderr, retcode
-
 
 def check_repo_exists(url, username, password):
     try:
@@ -119,10 +67,15 @@ def init_argparse():
                         default=get_octopusvariable_quiet('Octopus.Deployment.Tenant.Name'))
     parser.add_argument('--template-repo-name',
                         action='store',
-                        default=re.sub('[^a-zA-Z0-9]', '_', get_octopusvariable_quiet('Octopus.Project.Name').lower()))
+                        default=NON_ALPHANUMERIC_RE.sub('_', get_octopusvariable_quiet('Octopus.Project.Name').lower()))
     parser.add_argument('--repo-name',
                         action='store',
                         default='')
+    parser.add_argument('--git-mirror-dir',
+                        action='store',
+                        default=get_octopusvariable_quiet('Git.Mirror.Directory') or get_octopusvariable_quiet(
+                            'MergeRepo.Git.Mirror.Directory') or os.path.join(tempfile.gettempdir(),
+                                                                               'octopus_git_mirrors'))
     return parser.parse_known_args()
 
 
@@ -134,16 +87,16 @@ def set_git_user():
     execute(['git', 'config', '--global', 'user.name', 'Octopus Server'])
 
 
-def clone_repo(template_repo_name_url, branch):
+def clone_repo(template_mirror_dir, template_repo_name_url, branch):
     """
     Clone the template repo into the template directory
+    :param template_mirror_dir: The directory holding the mirror of the template repo
     :param template_repo_name_url: The template repo url
     :param branch: The branch holding the template code
     :return: The directory holding the template repo
     """
     # Clone the template repo to test for a step template reference
-    os.mkdir('template')
-    execute(['git', 'clone', template_repo_name_url, 'template'])
+    clone_from_mirror(template_mirror_dir, template_repo_name_url, 'template')
     if branch != 'master' and branch != 'main':
         execute(['git', 'checkout', '-b', branch, 'origin/' + branch], cwd='template')
     else:
@@ -151,17 +104,17 @@ def clone_repo(template_repo_name_url, branch):
     return 'template'
 
 
-def add_upstream_remote(new_repo_url_wth_creds, template_repo_name_url_with_creds, new_repo):
+def add_upstream_remote(new_repo_url_wth_creds, template_mirror_dir, new_repo, mirror_root):
     """
     Clone the downstream repo and link the upstream remote
     :param new_repo_url_wth_creds: The downstream repo url
-    :param template_repo_name_url_with_creds: The upstream repo
+    :param template_mirror_dir: The directory holding the mirror of the upstream repo
     :param new_repo: The directory to clone the downstream repo into
+    :param mirror_root: The directory holding all the repo mirrors
     :return:
     """
-    execute(['git', 'clone', new_repo_url_wth_creds])
-    execute(['git', 'remote', 'add', 'upstream', template_repo_name_url_with_creds], cwd=new_repo)
-    execute(['git', 'fetch', '--all'], cwd=new_repo)
+    mirror_dir = update_mirror(new_repo_url_wth_creds, mirror_root)
+    clone_from_mirror(mirror_dir, new_repo_url_wth_creds, new_repo, template_mirror_dir)
     execute(['git', 'checkout', '-b', 'upstream-' + branch, 'upstream/' + branch], cwd=new_repo)
 
     # Checkout the project branch, assuming "main" or "master" are already linked upstream
@@ -239,9 +192,9 @@ def merge_changes(branch, new_repo, template_repo_name_url, new_repo_url):
 
 parser, _ = init_argparse()
 
-tenant_name_sanitized = re.sub('[^a-zA-Z0-9]', '_', parser.tenant_name.lower())
-new_project_name_sanitized = re.sub('[^a-zA-Z0-9]', '_', parser.new_project_name.lower())
-original_project_name_sanitized = re.sub('[^a-zA-Z0-9]', '_', parser.original_project_name.lower())
+tenant_name_sanitized = NON_ALPHANUMERIC_RE.sub('_', parser.tenant_name.lower())
+new_project_name_sanitized = NON_ALPHANUMERIC_RE.sub('_', parser.new_project_name.lower())
+original_project_name_sanitized = NON_ALPHANUMERIC_RE.sub('_', parser.original_project_name.lower())
 project_name_sanitized = new_project_name_sanitized if len(new_project_name_sanitized) != 0 \
     else original_project_name_sanitized
 new_repo = parser.repo_name if len(parser.repo_name) != 0 else tenant_name_sanitized + '_' + project_name_sanitized
@@ -266,7 +219,8 @@ if not check_repo_exists(template_repo_name_url, parser.git_username, parser.git
     sys.exit(1)
 
 set_git_user()
-template_dir = clone_repo(template_repo_name_url, branch)
+template_mirror_dir = update_mirror(template_repo_name_url_with_creds, parser.git_mirror_dir)
+template_dir = clone_repo(template_mirror_dir, template_repo_name_url, branch)
 check_action_templates(project_dir, template_dir)
-add_upstream_remote(new_repo_url_wth_creds, template_repo_name_url_with_creds, new_repo)
+add_upstream_remote(new_repo_url_wth_creds, template_mirror_dir, new_repo, parser.git_mirror_dir)
 merge_changes(branch, new_repo, template_repo_name_url, new_repo_url)
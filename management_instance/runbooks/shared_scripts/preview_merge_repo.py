@@ -3,78 +3,27 @@
 # installed and ready to use.
 
 import argparse
-import subprocess
 import sys
 import os
+import tempfile
 import urllib.request
 import base64
-import re
+
+# Octopus steps prepend the shared helpers to this script. When the script is run directly, they are imported
+# from runbook_helpers.py in the same directory.
+if "execute" not in globals():
+    from runbook_helpers import *
 
 # If this script is not being run as part of an Octopus step, createartifact is a noop
 if "createartifact" not in globals():
     def createartifact(file, name):
         pass
 
-# If this script is not being run as part of an Octopus step, print directly to std out.
-if "printverbose" not in globals():
-    def printverbose(msg):
-        print(msg)
 
 if "printhighlight" not in globals():
     def printhighlight(msg):
         print(msg)
 
-# If this script is not being run as part of an Octopus step, return variables from environment variables.
-# Periods are replaced with underscores, and the variable name is converted to uppercase
-if "get_octopusvariable" not in globals():
-    def get_octopusvariable(variable):
-        return os.environ[re.sub('\\.', '_', variable.upper())]
-
-
-def get_octopusvariable_quiet(variable):
-    """
-    Gets an octopus variable, or an empty string if it does not exist.
-    :param variable: The variable name
-    :return: The variable value, or an empty string if the variable does not exist
-    """
-    try:
-        return get_octopusvariable(variable)
-    except:
-        return ''
-
-
-def printverbose_noansi(output):
-    """
-    Strip ANSI color codes and print the output as verbose
-    :param output: The output to print
-    """
-    output_no_ansi = re.sub('\x1b\[[0-9;]*m', '', output)
-    printverbose(output_no_ansi)
-
-
-def execute(args, cwd=None, env=None, print_args=None, print_output=printverbose_noansi):
-    """
-        The execute method provides the ability to execute external processes while capturing and returning the
-        output to std err and std out and exit code.
-    """
-    process = subprocess.Popen(args,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               text=True,
-                               cwd=cwd,
-                               env=env)
-    stdout, stderr = process.communicate()
-    retcode = process.returncode
-
-    if print_args is not None:
-        print_output(' '.join(args))
-
-    if print_output is not None:
-        print_output(stdout)
-        print_output(stderr)
-
-    return stdout, stderr, retcode
-
 
 def check_repo_exists(url, username, password):
     try:
@@ -127,11 +76,16 @@ def init_argparse():
                         default=get_octopusvariable_quiet('Octopus.Deployment.Tenant.Name'))
     parser.add_argument('--template-repo-name',
                         action='store',
-                        default=re.sub('[^a-zA-Z0-9]', '_', get_octopusvariable_quiet('Octopus.Project.Name').lower()))
+                        default=NON_ALPHANUMERIC_RE.sub('_', get_octopusvariable_quiet('Octopus.Project.Name').lower()))
     parser.add_argument('--repo-name',
                         action='store',
                         default=get_octopusvariable_quiet('Git.Url.RepoName') or get_octopusvariable_quiet(
                             'PreviewMerge.Git.Url.RepoName'))
+    parser.add_argument('--git-mirror-dir',
+                        action='store',
+                        default=get_octopusvariable_quiet('Git.Mirror.Directory') or get_octopusvariable_quiet(
+                            'PreviewMerge.Git.Mirror.Directory') or os.path.join(tempfile.gettempdir(),
+                                                                                  'octopus_git_mirrors'))
     parser.add_argument('--generate-diff',
                         action='store_true',
                         default='false')
@@ -144,9 +98,9 @@ def init_argparse():
 parser, _ = init_argparse()
 
 exit_code = 0 if parser.silent_fail else 1
-tenant_name_sanitized = re.sub('[^a-zA-Z0-9]', '_', parser.tenant_name.lower())
-new_project_name_sanitized = re.sub('[^a-zA-Z0-9]', '_', parser.new_project_name.lower())
-original_project_name_sanitized = re.sub('[^a-zA-Z0-9]', '_', parser.original_project_name.lower())
+tenant_name_sanitized = NON_ALPHANUMERIC_RE.sub('_', parser.tenant_name.lower())
+new_project_name_sanitized = NON_ALPHANUMERIC_RE.sub('_', parser.new_project_name.lower())
+original_project_name_sanitized = NON_ALPHANUMERIC_RE.sub('_', parser.original_project_name.lower())
 project_name_sanitized = new_project_name_sanitized if len(new_project_name_sanitized) != 0 \
     else original_project_name_sanitized
 new_repo = parser.repo_name if len(parser.repo_name) != 0 else tenant_name_sanitized + '_' + project_name_sanitized
@@ -174,9 +128,11 @@ if not check_repo_exists(template_repo_name_url, parser.git_username, parser.git
 execute(['git', 'config', '--global', 'user.email', 'octopus@octopus.com'])
 execute(['git', 'config', '--global', 'user.name', 'Octopus Server'])
 
+# The template repo is fetched once into its mirror, and shared by the template and downstream clones
+template_mirror_dir = update_mirror(template_repo_name_url_with_creds, parser.git_mirror_dir)
+
 # Clone the template repo to test for a step template reference
-os.mkdir('template')
-execute(['git', 'clone', template_repo_name_url, 'template'])
+clone_from_mirror(template_mirror_dir, template_repo_name_url, 'template')
 if branch != 'master' and branch != 'main':
     execute(['git', 'checkout', '-b', branch, 'origin/' + branch], cwd='template')
 else:
@@ -195,10 +151,8 @@ except Exception as ex:
 
 # Merge the template changes
 repo_dir = 'repo'
-os.mkdir(repo_dir)
-execute(['git', 'clone', new_repo_url_wth_creds, repo_dir])
-execute(['git', 'remote', 'add', 'upstream', template_repo_name_url_with_creds], cwd=repo_dir)
-execute(['git', 'fetch', '--all'], cwd=repo_dir)
+repo_mirror_dir = update_mirror(new_repo_url_wth_creds, parser.git_mirror_dir)
+clone_from_mirror(repo_mirror_dir, new_repo_url_wth_creds, repo_dir, template_mirror_dir)
 execute(['git', 'checkout', '-b', 'upstream-' + branch, 'upstream/' + branch], cwd=repo_dir)
 
 # Checkout the project branch, assuming "main" or "master" are already linked upstream
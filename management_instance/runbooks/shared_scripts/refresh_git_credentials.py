@@ -9,92 +9,65 @@
 import sys
 import subprocess
 
-# Install our own dependencies
-subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'jwt'])
-
-import jwt
-import time
-import urllib.request
-import urllib.error
+import tempfile
 import os
-import json
-
-# If this script is not being run as part of an Octopus step, return variables from environment variables.
-# Periods are replaced with underscores, and the variable name is converted to uppercase
-if "get_octopusvariable" not in globals():
-    def get_octopusvariable(variable):
-        return os.environ[re.sub('\\.', '_', variable.upper())]
-
-# If this script is not being run as part of an Octopus step, print directly to std out.
-if "printverbose" not in globals():
-    def printverbose(msg):
-        print(msg)
-
-app_id = get_octopusvariable('GitHub.App.Id')
-signing_key = jwt.jwk_from_pem(get_octopusvariable('GitHub.App.PrivateKey').encode("utf-8"))
-
-payload = {
-    # Issued at time
-    'iat': int(time.time()),
-    # JWT expiration time (10 minutes maximum)
-    'exp': int(time.time()) + 600,
-    # GitHub App's identifier
-    'iss': app_id
-}
-
-# Create JWT
-jwt_instance = jwt.JWT()
-encoded_jwt = jwt_instance.encode(payload, signing_key, alg='RS256')
-
-# Create access token
-url = "https://api.github.com/app/installations/" + get_octopusvariable('GitHub.App.InstallationId') + "/access_tokens"
-headers = {
-    'Authorization': 'Bearer ' + encoded_jwt,
-    'Accept': 'application/vnd.github+json',
-    'X-GitHub-Api-Version': '2022-11-28'
-}
-request = urllib.request.Request(url, headers=headers, method='POST')
-response = urllib.request.urlopen(request)
-response_json = json.loads(response.read().decode())
-token = response_json['token']
-
-# Update git credentials
-
-url = get_octopusvariable('Global.Octopus.ServerUrl') + '/api/Spaces'
-headers = {
-    "X-Octopus-ApiKey": get_octopusvariable('Global.Octopus.ApiKey'),
-    'Accept': 'application/json'
-}
-request = urllib.request.Request(url, headers=headers)
-response = urllib.request.urlopen(request)
-spaces_json = json.loads(response.read().decode())
-
-for space in spaces_json['Items']:
-    space_id = space['Id']
-
-    url = get_octopusvariable('Global.Octopus.ServerUrl') + '/api/' + space_id + '/Git-Credentials'
-    headers = {
-        "X-Octopus-ApiKey": get_octopusvariable('Global.Octopus.ApiKey'),
-        'Accept': 'application/json'
-    }
-    request = urllib.request.Request(url, headers=headers)
-
+from concurrent.futures import ThreadPoolExecutor
+
+# Install our own dependencies, skipping pip when the worker already has them
+try:
+    import requests
+except ImportError:
+    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'requests'])
+    import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Octopus steps prepend the shared helpers to this script. When the script is run directly, they are imported
+# from runbook_helpers.py in the same directory.
+if "execute" not in globals():
+    from runbook_helpers import *
+
+
+def create_octopus_session(api_key, parallelism):
+    """
+    Creates a session that keeps a pool of connections open to the Octopus server, so each request does not open a new
+    connection. Requests that fail with a server error are retried with an exponential backoff.
+    :param api_key: The Octopus API key
+    :param parallelism: The number of connections kept open, which matches the number of concurrent requests
+    :return: The requests session
+    """
+    session = requests.Session()
+    session.headers.update({'X-Octopus-ApiKey': api_key, 'Accept': 'application/json'})
+    retries = Retry(total=4, backoff_factor=1, status_forcelist=[500, 502, 503, 504],
+                    allowed_methods=['GET', 'PUT'])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=parallelism, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def refresh_space(space):
+    """
+    Updates the git credential in a space with the new token.
+    This function is run concurrently, so the result is returned rather than printed directly.
+    :param space: The space resource
+    :return: A tuple with the result, one of "refreshed", "skipped" or "failed", and a message describing the result
+    """
+    # Unexpected responses, such as invalid JSON or missing fields, fail this space without stopping the others
     try:
-        response = urllib.request.urlopen(request)
-    except urllib.error.HTTPError as e:
-        print('Failed to get git creds from ' + space['Name'] + ': ', e)
-        continue
-
-    git_creds_json = json.loads(response.read().decode())
-
-    for git_cred in git_creds_json['Items']:
-        if git_cred['Name'] == get_octopusvariable('Octopus.GitHubAppCreds.Name'):
-            url = get_octopusvariable('Global.Octopus.ServerUrl') + '/api/' + space_id + '/Git-Credentials/' + \
-                  git_cred['Id']
-            headers = {
-                "X-Octopus-ApiKey": get_octopusvariable('Global.Octopus.ApiKey'),
-                'Accept': 'application/json'
-            }
+        response = session.get(server_url + '/api/' + space['Id'] + '/Git-Credentials',
+                               params={'take': 10000}, timeout=60)
+        response.raise_for_status()
+        git_creds = [x for x in response.json()['Items'] if x['Name'] == git_creds_name]
+    except (requests.RequestException, KeyError, TypeError, ValueError) as e:
+        return 'failed', 'Failed to get git creds from ' + space['Name'] + ': ' + repr(e)
+
+    if len(git_creds) == 0:
+        return 'skipped', 'No git creds called ' + git_creds_name + ' in space ' + space['Name']
+
+    for git_cred in git_creds:
+        try:
             body = {
                 'Name': git_cred['Name'],
                 'Details': {
@@ -106,10 +79,47 @@ for space in spaces_json['Items']:
                     'Username': 'x-access-token'
                 }
             }
-            request = urllib.request.Request(url, headers=headers, data=json.dumps(body).encode("utf-8"), method='PUT')
 
-            try:
-                response = urllib.request.urlopen(request)
-                print('Refreshed creds in space ' + space['Name'])
-            except urllib.error.HTTPError as e:
-                print('Failed to update git creds in space ' + space['Name'] + ':', e)
+            response = session.put(server_url + '/api/' + space['Id'] + '/Git-Credentials/' + git_cred['Id'],
+                                   json=body, timeout=60)
+            response.raise_for_status()
+        except (requests.RequestException, KeyError, TypeError, ValueError) as e:
+            return 'failed', 'Failed to update git creds in space ' + space['Name'] + ': ' + repr(e)
+
+    return 'refreshed', 'Refreshed creds in space ' + space['Name']
+
+
+# The token saved to the git credentials must remain valid until the next time this script runs
+token = get_github_token(get_octopusvariable('GitHub.App.Id'), get_octopusvariable('GitHub.App.PrivateKey'),
+                         get_octopusvariable('GitHub.App.InstallationId'),
+                         get_octopusvariable_quiet('GitHub.Token.Cache.Directory') or os.path.join(
+                             tempfile.gettempdir(), 'octopus_github_tokens'),
+                         min_lifetime=45 * 60)
+
+# Update git credentials
+server_url = get_octopusvariable('Global.Octopus.ServerUrl').rstrip('/')
+git_creds_name = get_octopusvariable('Octopus.GitHubAppCreds.Name')
+parallelism = max(1, int(get_octopusvariable_quiet('Octopus.GitHubAppCreds.Parallelism') or '8'))
+session = create_octopus_session(get_octopusvariable('Global.Octopus.ApiKey'), parallelism)
+
+response = session.get(server_url + '/api/Spaces/all', timeout=60)
+response.raise_for_status()
+spaces = response.json()
+
+# Spaces are refreshed concurrently, but executor.map() returns the results in the order the spaces were listed,
+# so the log is stable between runs
+results = {'refreshed': [], 'skipped': [], 'failed': []}
+with ThreadPoolExecutor(max_workers=parallelism) as executor:
+    for space, (result, message) in zip(spaces, executor.map(refresh_space, spaces)):
+        results[result].append(space['Name'])
+        if result == 'skipped':
+            printverbose(message)
+        else:
+            print(message)
+
+print('Refreshed ' + str(len(results['refreshed'])) + ', skipped ' + str(len(results['skipped'])) +
+      ' and failed ' + str(len(results['failed'])) + ' of ' + str(len(spaces)) + ' spaces')
+
+if len(results['failed']) != 0:
+    print('Failed to refresh the git creds in the following spaces: ' + ', '.join(results['failed']))
+    sys.exit(1)
@@ -0,0 +1,722 @@
+# Helpers shared by the runbook scripts. Octopus script steps run a single file, so the steps prepend this file to
+# the script body. When a script is run directly, it imports these helpers from this file instead.
+
+import hashlib
+import importlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from collections import deque, namedtuple
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are not available on Windows
+    fcntl = None
+
+# Regular expressions are compiled once, as some of them are applied to every line of process output
+ANSI_ESCAPE_RE = re.compile('\x1b\\[[0-9;]*m')
+NON_ALPHANUMERIC_RE = re.compile('[^a-zA-Z0-9]')
+PG_BACKEND_CONFIG_RE = re.compile('^-backend-config=(conn_str|schema_name)=(.*)$')
+REMOTE_HEAD_RE = re.compile('^ref: (refs/heads/\\S+)\\s+HEAD', re.MULTILINE)
+
+# If this script is not being run as part of an Octopus step, return variables from environment variables.
+# Periods are replaced with underscores, and the variable name is converted to uppercase
+if "get_octopusvariable" not in globals():
+    def get_octopusvariable(variable):
+        return os.environ[variable.upper().replace('.', '_')]
+
+# If this script is not being run as part of an Octopus step, print directly to std out.
+if "printverbose" not in globals():
+    def printverbose(msg):
+        print(msg)
+
+
+def get_octopusvariable_quiet(variable):
+    """
+    Gets an octopus variable, or an empty string if it does not exist.
+    :param variable: The variable name
+    :return: The variable value, or an empty string if the variable does not exist
+    """
+    try:
+        return get_octopusvariable(variable)
+    except:
+        return ''
+
+
+def printverbose_noansi(output):
+    """
+    Strip ANSI color codes and print the output as verbose
+    :param output: The output to print
+    """
+    output_no_ansi = ANSI_ESCAPE_RE.sub('', output)
+    printverbose(output_no_ansi)
+
+
+def execute(args, cwd=None, env=None, print_args=None, print_output=printverbose_noansi, timeout=None,
+            max_output_lines=None):
+    """
+        The execute method provides the ability to execute external processes while capturing and returning the
+        output to std err and std out and exit code. The output is streamed line by line to print_output while the
+        process runs. Set max_output_lines to keep only the tail of each stream in memory for the returned values,
+        and timeout to kill the process after the supplied number of seconds.
+    """
+    if print_args is not None and print_output is not None:
+        print_output(' '.join(args))
+
+    process = subprocess.Popen(args,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               text=True,
+                               cwd=cwd,
+                               env=env)
+
+    stdout_lines = deque(maxlen=max_output_lines)
+    stderr_lines = deque(maxlen=max_output_lines)
+    print_lock = threading.Lock()
+
+    def read_stream(stream, lines):
+        for line in stream:
+            lines.append(line)
+            if print_output is not None:
+                with print_lock:
+                    print_output(line.rstrip('\n'))
+        stream.close()
+
+    readers = [threading.Thread(target=read_stream, args=(process.stdout, stdout_lines)),
+               threading.Thread(target=read_stream, args=(process.stderr, stderr_lines))]
+    for reader in readers:
+        reader.start()
+
+    try:
+        retcode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        retcode = process.wait()
+        stderr_lines.append('Command timed out after ' + str(timeout) + ' seconds\n')
+        if print_output is not None:
+            with print_lock:
+                print_output('Command timed out after ' + str(timeout) + ' seconds')
+
+    for reader in readers:
+        reader.join()
+
+    return ''.join(stdout_lines), ''.join(stderr_lines), retcode
+
+
+DownstreamProject = namedtuple('DownstreamProject',
+                               ['workspace', 'space_id', 'space_name', 'project_name', 'git_url', 'outputs'])
+
+
+def get_pg_backend_settings(backend_type, init_args):
+    """
+    Extracts the Postgres connection details from the "terraform init" arguments.
+    :param backend_type: The Terraform backend type
+    :param init_args: The "-backend-config" arguments passed to "terraform init"
+    :return: A tuple with the connection string and schema name, or None if the backend is not a Postgres backend
+    """
+    if backend_type != 'pg':
+        return None
+
+    settings = {}
+    for arg in init_args:
+        match = PG_BACKEND_CONFIG_RE.match(arg)
+        if match:
+            settings[match.group(1)] = match.group(2)
+
+    if 'conn_str' not in settings:
+        return None
+
+    return settings['conn_str'], settings.get('schema_name', 'terraform_remote_state')
+
+
+def connect_pg(conn_str):
+    """
+    Opens a connection to a Postgres database, installing the driver if it is not available.
+    :param conn_str: The Postgres connection string
+    :return: The psycopg2 connection
+    """
+    try:
+        import psycopg2
+    except ImportError:
+        # Install our own dependencies
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'psycopg2-binary'])
+        import psycopg2
+
+    return psycopg2.connect(conn_str)
+
+
+def read_pg_workspace_states(conn_str, schema_name, workspaces=None):
+    """
+    Reads the state of every workspace from a Terraform Postgres backend in a single query.
+    :param conn_str: The Postgres connection string
+    :param schema_name: The schema holding the Terraform states table
+    :param workspaces: An optional list of workspace names to limit the query to
+    :return: A list of (workspace, state) tuples, where state is the parsed raw Terraform state
+    """
+    connection = connect_pg(conn_str)
+    from psycopg2 import sql
+
+    try:
+        with connection.cursor() as cursor:
+            if workspaces is None:
+                cursor.execute(sql.SQL('SELECT name, data FROM {}.states ORDER BY name').format(
+                    sql.Identifier(schema_name)))
+            else:
+                cursor.execute(sql.SQL('SELECT name, data FROM {}.states WHERE name = ANY(%s) ORDER BY name').format(
+                    sql.Identifier(schema_name)), (list(workspaces),))
+            return [(name, json.loads(data)) for name, data in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def read_pg_workspace_versions(conn_str, schema_name):
+    """
+    Reads the lineage and serial of every workspace from a Terraform Postgres backend. The state documents are
+    inspected by the database, so only these two values are returned rather than the complete states.
+    :param conn_str: The Postgres connection string
+    :param schema_name: The schema holding the Terraform states table
+    :return: A dict mapping workspace names to (lineage, serial) tuples
+    """
+    connection = connect_pg(conn_str)
+    from psycopg2 import sql
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT name, data::jsonb ->> 'lineage', (data::jsonb ->> 'serial')::bigint "
+                                   "FROM {}.states").format(sql.Identifier(schema_name)))
+            return {name: (lineage, serial) for name, lineage, serial in cursor.fetchall()}
+    finally:
+        connection.close()
+
+
+def get_raw_state_resources(state):
+    """
+    Returns the root module resources from a raw Terraform state in the same shape as "terraform show -json".
+    :param state: The raw Terraform state
+    :return: A list of resources with their type, name and values
+    """
+    return [{'type': resource.get('type'), 'name': resource.get('name'), 'values': instance.get('attributes', {})}
+            for resource in state.get('resources', [])
+            if resource.get('mode') == 'managed' and 'module' not in resource
+            for instance in resource.get('instances', [])]
+
+
+def get_raw_state_outputs(state):
+    """
+    Returns the output values from a raw Terraform state.
+    :param state: The raw Terraform state
+    :return: A dict mapping output names to their values
+    """
+    return {name: output.get('value') for name, output in state.get('outputs', {}).items()}
+
+
+def get_downstream_projects(workspace, resources, outputs):
+    """
+    Builds the downstream project records from the resources and outputs of a workspace.
+    :param workspace: The name of the Terraform workspace
+    :param resources: The workspace resources, in the shape returned by "terraform show -json"
+    :param outputs: A dict mapping output names to their values
+    :return: A list of DownstreamProject records
+    """
+    projects = []
+    for resource in resources:
+        if resource.get('type', '') != 'octopusdeploy_project':
+            continue
+
+        values = resource.get('values', {})
+        git_settings = values.get('git_library_persistence_settings') or []
+        url = git_settings[0].get('url', None) if len(git_settings) != 0 else None
+        projects.append(DownstreamProject(workspace, values.get('space_id', None),
+                                          outputs.get('octopus_space_name', None), values.get('name', None), url,
+                                          outputs))
+    return projects
+
+
+def read_downstream_projects_from_backend(backend_type, init_args):
+    """
+    Reads the downstream projects directly from the Terraform backend, avoiding the need to select each workspace
+    and query it with the Terraform CLI.
+    :param backend_type: The Terraform backend type
+    :param init_args: The "-backend-config" arguments passed to "terraform init"
+    :return: A list of DownstreamProject records, or None if the backend could not be read directly
+    """
+    settings = get_pg_backend_settings(backend_type, init_args)
+    if settings is None:
+        return None
+
+    try:
+        states = read_pg_workspace_states(*settings)
+    except Exception as ex:
+        printverbose('Failed to read the workspace states from the backend, falling back to the Terraform CLI: ' +
+                     str(ex))
+        return None
+
+    return [project for workspace, state in states if workspace != 'default'
+            for project in get_downstream_projects(workspace, get_raw_state_resources(state),
+                                                   get_raw_state_outputs(state))]
+
+
+def open_downstream_index(index_file):
+    """
+    Opens the local index of downstream projects, creating it if it does not exist.
+    :param index_file: The path to the SQLite index file
+    :return: The SQLite connection
+    """
+    # The index is private, as it lists the projects of every tenant
+    os.makedirs(os.path.dirname(index_file), mode=0o700, exist_ok=True)
+    index = sqlite3.connect(index_file, timeout=60)
+    index.executescript("""
+        CREATE TABLE IF NOT EXISTS workspaces (workspace TEXT PRIMARY KEY, lineage TEXT, serial INTEGER);
+        CREATE TABLE IF NOT EXISTS projects (workspace TEXT NOT NULL, space_id TEXT, space_name TEXT,
+                                             project_name TEXT, git_url TEXT);
+        CREATE INDEX IF NOT EXISTS projects_workspace ON projects (workspace);
+    """)
+    return index
+
+
+def update_downstream_index(index, workspace_versions, read_states):
+    """
+    Brings the index up to date with the backend. Only workspaces whose state lineage or serial changed since the
+    previous run are read from the backend, and workspaces that no longer exist are removed.
+    :param index: The SQLite connection returned by open_downstream_index
+    :param workspace_versions: A dict mapping workspace names to their current (lineage, serial) tuples
+    :param read_states: A function that accepts a list of workspace names and returns their (workspace, state) tuples
+    :return: The number of workspaces that were read from the backend
+    """
+    indexed_versions = {workspace: (lineage, serial) for workspace, lineage, serial in
+                        index.execute('SELECT workspace, lineage, serial FROM workspaces')}
+    changed_workspaces = [workspace for workspace, version in workspace_versions.items()
+                          if indexed_versions.get(workspace) != version]
+    removed_workspaces = [workspace for workspace in indexed_versions if workspace not in workspace_versions]
+    states = read_states(changed_workspaces) if len(changed_workspaces) != 0 else []
+
+    with index:
+        for workspace in removed_workspaces + changed_workspaces:
+            index.execute('DELETE FROM workspaces WHERE workspace = ?', (workspace,))
+            index.execute('DELETE FROM projects WHERE workspace = ?', (workspace,))
+
+        for workspace, state in states:
+            # The version recorded is the one in the state that was read, so a workspace updated between the two
+            # queries is simply read again on the next run
+            index.execute('INSERT INTO workspaces (workspace, lineage, serial) VALUES (?, ?, ?)',
+                          (workspace, state.get('lineage'), state.get('serial')))
+            # Outputs are not indexed, as they include sensitive values like API keys
+            index.executemany('INSERT INTO projects (workspace, space_id, space_name, project_name, git_url) '
+                              'VALUES (?, ?, ?, ?, ?)',
+                              [(project.workspace, project.space_id, project.space_name, project.project_name,
+                                project.git_url)
+                               for project in get_downstream_projects(workspace, get_raw_state_resources(state),
+                                                                      get_raw_state_outputs(state))])
+
+    return len(states)
+
+
+def read_downstream_projects_from_index(backend_type, init_args, index_dir):
+    """
+    Reads the downstream projects from a local index that is incrementally updated from the Terraform backend.
+    Most workspaces do not change between runs, so only the lineage and serial of each state are queried, and only
+    the states that changed are downloaded and parsed.
+    :param backend_type: The Terraform backend type
+    :param init_args: The "-backend-config" arguments passed to "terraform init"
+    :param index_dir: The directory holding the index files
+    :return: A list of DownstreamProject records without outputs, or None if the backend could not be read directly
+    """
+    settings = get_pg_backend_settings(backend_type, init_args)
+    if settings is None:
+        return None
+
+    try:
+        workspace_versions = read_pg_workspace_versions(*settings)
+    except Exception as ex:
+        printverbose('Failed to read the workspace states from the backend, falling back to the Terraform CLI: ' +
+                     str(ex))
+        return None
+
+    workspace_versions.pop('default', None)
+
+    # Each backend gets its own index. The init args can include credentials, so they are hashed.
+    index_file = os.path.join(index_dir, hashlib.sha256(
+        '\n'.join([backend_type] + init_args).encode('utf-8')).hexdigest()[:16] + '.sqlite')
+
+    try:
+        index = open_downstream_index(index_file)
+        try:
+            read_count = update_downstream_index(index, workspace_versions,
+                                                 lambda workspaces: read_pg_workspace_states(*settings, workspaces))
+            printverbose('Read ' + str(read_count) + ' of ' + str(len(workspace_versions)) +
+                         ' workspaces from the backend, the rest were unchanged since the previous run')
+            return [DownstreamProject(*row, {}) for row in index.execute(
+                'SELECT workspace, space_id, space_name, project_name, git_url FROM projects '
+                'ORDER BY workspace, rowid')]
+        finally:
+            index.close()
+    except sqlite3.Error as ex:
+        printverbose('Failed to use the downstream project index, reading all workspaces: ' + str(ex))
+        return read_downstream_projects_from_backend(backend_type, init_args)
+
+
+def init_terraform_cached(backend_config, init_args, cache_dir):
+    """
+    Initializes Terraform in a persistent data directory that is reused by later runs with the same backend
+    configuration. Providers are downloaded once into a shared plugin cache, and the dependency lock file created by
+    the first init is restored before each init so cached providers are verified against the recorded checksums.
+    The init is skipped when the data directory has already been initialized with the same configuration.
+    :param backend_config: The contents of the backend.tf file
+    :param init_args: The additional arguments passed to "terraform init"
+    :param cache_dir: The directory holding the plugin cache and the initialized data directories
+    :return: The path to the initialized data directory, which is also exported as TF_DATA_DIR
+    """
+    # The init args can include credentials, so they only contribute to a hash and are never written to the path
+    init_hash = hashlib.sha256('\n'.join([backend_config] + init_args).encode('utf-8')).hexdigest()[:16]
+    plugin_cache_dir = os.path.join(cache_dir, 'plugins')
+    data_root = os.path.join(cache_dir, 'data')
+    data_dir = os.path.join(data_root, init_hash)
+    lock_file = os.path.join(data_root, init_hash + '.terraform.lock.hcl')
+    init_marker = os.path.join(data_dir, '.octopus_init_complete')
+
+    os.makedirs(plugin_cache_dir, exist_ok=True)
+    # The data directory holds the backend configuration, including any credentials
+    os.makedirs(data_root, mode=0o700, exist_ok=True)
+
+    env = dict(os.environ, TF_DATA_DIR=data_dir, TF_PLUGIN_CACHE_DIR=plugin_cache_dir)
+
+    # Serialize concurrent runs initializing the same data directory
+    with open(data_dir + '.lock', 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(lock_file):
+                shutil.copyfile(lock_file, '.terraform.lock.hcl')
+
+            if os.path.exists(init_marker):
+                printverbose('Reusing the Terraform data directory initialized by a previous run')
+            else:
+                _, _, retcode = execute(['terraform', 'init', '-no-color'] + init_args, env=env)
+                if retcode == 0:
+                    if os.path.exists('.terraform.lock.hcl'):
+                        shutil.copyfile('.terraform.lock.hcl', lock_file)
+                    open(init_marker, 'w').close()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    os.environ.update(TF_DATA_DIR=data_dir, TF_PLUGIN_CACHE_DIR=plugin_cache_dir)
+    return data_dir
+
+
+def list_workspaces(cwd=None):
+    """
+    Lists the Terraform workspaces, excluding the default workspace.
+    :param cwd: The directory holding the initialized Terraform configuration
+    :return: The list of workspace names
+    """
+    workspaces, _, _ = execute(['terraform', 'workspace', 'list'], cwd=cwd)
+    workspaces = [x.strip() for x in workspaces.replace('*', '').split('\n')]
+    return [x for x in workspaces if x != 'default' and x != '']
+
+
+def read_downstream_projects_with_terraform(workspace, cwd=None, env=None):
+    """
+    Reads the downstream projects from a single workspace with the Terraform CLI. This is the fallback used when
+    the backend can not be read directly. The raw state holds both the resources and the outputs, so a single
+    "terraform state pull" replaces the "terraform show -json" and "terraform output" calls, and does not need
+    to start the provider plugins.
+    :param workspace: The name of the Terraform workspace
+    :param cwd: The directory holding the initialized Terraform configuration
+    :param env: The environment variables to pass to Terraform
+    :return: A list of DownstreamProject records
+    """
+    workspace_env = dict(env or os.environ, TF_WORKSPACE=workspace)
+
+    # The state includes sensitive outputs like the API key, so it is not printed
+    state_json, stderr, retcode = execute(['terraform', 'state', 'pull'], cwd=cwd, env=workspace_env,
+                                          print_output=None)
+
+    if retcode != 0:
+        printverbose_noansi(stderr)
+        return []
+
+    state = json.loads(state_json or '{}')
+    return get_downstream_projects(workspace, get_raw_state_resources(state), get_raw_state_outputs(state))
+
+
+def get_mirror_dir(mirror_root, url):
+    """
+    Returns the directory holding the bare mirror of a repo. Mirrors are keyed by the repo URL with any
+    credentials removed, so the same mirror is shared regardless of the credentials used to fetch it.
+    :param mirror_root: The directory holding all the mirrors
+    :param url: The repo URL
+    :return: The directory holding the bare mirror
+    """
+    parsed_url = urlparse(url)
+    url_without_creds = parsed_url._replace(netloc=parsed_url.netloc.rsplit('@', 1)[-1]).geturl()
+    url_hash = hashlib.sha256(url_without_creds.encode('utf-8')).hexdigest()[:16]
+    repo_name = NON_ALPHANUMERIC_RE.sub('_', os.path.basename(parsed_url.path.rstrip('/')))
+    return os.path.join(mirror_root, repo_name + '_' + url_hash + '.git')
+
+
+def update_mirror(url, mirror_root, print_output=printverbose_noansi):
+    """
+    Creates or incrementally refreshes a bare mirror of a repo. The mirror persists between runbook runs, so only
+    objects that have changed since the last run are downloaded. The URL is passed to "git fetch" rather than saved
+    as a remote, so credentials are not written to the mirror.
+    :param url: The repo URL, including any credentials
+    :param mirror_root: The directory holding all the mirrors
+    :param print_output: The function used to print the output of git
+    :return: The directory holding the bare mirror
+    """
+    os.makedirs(mirror_root, mode=0o700, exist_ok=True)
+    mirror_dir = get_mirror_dir(mirror_root, url)
+
+    # Runbooks can run concurrently on the same worker, so only one process may update a mirror at a time
+    with open(mirror_dir + '.lock', 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(os.path.join(mirror_dir, 'HEAD')):
+                execute(['git', 'init', '--bare', mirror_dir], print_output=print_output)
+                # Match the default branch of the repo, so clones of the mirror check out the same branch
+                remote_head, _, _ = execute(['git', 'ls-remote', '--symref', url, 'HEAD'], cwd=mirror_dir,
+                                            print_output=print_output)
+                default_branch = REMOTE_HEAD_RE.search(remote_head)
+                if default_branch:
+                    execute(['git', 'symbolic-ref', 'HEAD', default_branch.group(1)], cwd=mirror_dir,
+                            print_output=print_output)
+            execute(['git', 'fetch', '--prune', '--force', url, '+refs/heads/*:refs/heads/*'], cwd=mirror_dir,
+                    print_output=print_output, max_output_lines=100)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return mirror_dir
+
+
+def clone_from_mirror(mirror_dir, url, dest, upstream_mirror_dir=None, print_output=printverbose_noansi):
+    """
+    Clones a repo from its local mirror. The clone borrows the mirror objects through git alternates rather than
+    copying them, and the origin remote is pointed back at the real repo so changes can be pushed.
+    :param mirror_dir: The directory holding the bare mirror of the repo
+    :param url: The repo URL to use as the origin remote
+    :param dest: The directory to clone the repo into
+    :param upstream_mirror_dir: The optional mirror of the upstream template repo, added as the upstream remote
+    :param print_output: The function used to print the output of git
+    """
+    execute(['git', 'clone', '--shared', mirror_dir, dest], print_output=print_output)
+    execute(['git', 'remote', 'set-url', 'origin', url], cwd=dest, print_output=print_output)
+
+    if upstream_mirror_dir is not None:
+        # The upstream objects are borrowed from the upstream mirror, so fetching the upstream remote only
+        # has to update the refs
+        with open(os.path.join(dest, '.git', 'objects', 'info', 'alternates'), 'a') as alternates:
+            alternates.write(os.path.join(os.path.abspath(upstream_mirror_dir), 'objects') + '\n')
+        execute(['git', 'remote', 'add', 'upstream', os.path.abspath(upstream_mirror_dir)], cwd=dest,
+                print_output=print_output)
+        execute(['git', 'fetch', 'upstream'], cwd=dest, print_output=print_output)
+
+
+def create_merge_repo(repo_dir, mirror_dirs, print_output=printverbose_noansi):
+    """
+    Creates a bare scratch repo that borrows the objects of the supplied mirrors through git alternates. This allows
+    commits from the downstream and upstream repos to be merged without cloning or checking out either repo.
+    :param repo_dir: The directory to create the scratch repo in
+    :param mirror_dirs: The directories holding the bare mirrors whose objects are borrowed
+    :param print_output: The function used to print the output of git
+    :return: The directory holding the scratch repo
+    """
+    execute(['git', 'init', '--bare', repo_dir], print_output=print_output)
+    with open(os.path.join(repo_dir, 'objects', 'info', 'alternates'), 'w') as alternates:
+        alternates.writelines([os.path.join(os.path.abspath(x), 'objects') + '\n' for x in mirror_dirs])
+    return repo_dir
+
+
+def get_commit(repo_dir, ref):
+    """
+    Resolves a ref to a commit ID.
+    :param repo_dir: The git directory, which may be a bare repo
+    :param ref: The ref to resolve
+    :return: The commit ID, or None if the ref does not exist
+    """
+    commit, _, retcode = execute(['git', '--git-dir', repo_dir, 'rev-parse', '--verify', '--quiet',
+                                  ref + '^{commit}'], print_output=None)
+    return commit.strip() if retcode == 0 else None
+
+
+def check_merge(repo_dir, branch_commit, upstream_commit, print_output=printverbose_noansi):
+    """
+    Tests merging the upstream commit into the downstream commit with a tree-only merge. This uses
+    "git merge-tree --write-tree", which works against bare repos and never writes a working tree.
+    :param repo_dir: The git directory holding both commits, which may be a bare repo
+    :param branch_commit: The downstream commit
+    :param upstream_commit: The upstream commit to be merged
+    :param print_output: The function used to print the output of git
+    :return: A tuple with the merge status, one of "up_to_date", "mergeable", "conflict" or "error", and the list of
+    conflicting paths
+    """
+    if branch_commit is None or upstream_commit is None:
+        return 'error', []
+
+    _, _, ancestor_result = execute(['git', '--git-dir', repo_dir, 'merge-base', '--is-ancestor', upstream_commit,
+                                     branch_commit], print_output=print_output)
+    if ancestor_result == 0:
+        return 'up_to_date', []
+
+    # The raw output is NUL separated, so it is not printed. The conflicting paths are returned instead.
+    merge_tree, _, merge_result = execute(['git', '--git-dir', repo_dir, 'merge-tree', '--write-tree', '--name-only',
+                                           '--no-messages', '-z', branch_commit, upstream_commit],
+                                          print_output=None)
+    if merge_result == 0:
+        return 'mergeable', []
+    if merge_result == 1:
+        # The output is the merged tree ID followed by the conflicting paths, all separated by NUL characters
+        return 'conflict', [x for x in merge_tree.split('\0')[1:] if x != '']
+
+    # Versions of git older than 2.38 do not support "git merge-tree --write-tree",
+    # so fall back to a trial merge in a temporary worktree
+    return check_merge_in_worktree(repo_dir, branch_commit, upstream_commit, print_output)
+
+
+def check_merge_in_worktree(repo_dir, branch_commit, upstream_commit, print_output=printverbose_noansi):
+    """
+    Tests merging the upstream commit into the downstream commit in a temporary worktree. This is the fallback for
+    versions of git that do not support tree-only merges.
+    :param repo_dir: The git directory holding both commits, which may be a bare repo
+    :param branch_commit: The downstream commit
+    :param upstream_commit: The upstream commit to be merged
+    :param print_output: The function used to print the output of git
+    :return: A tuple with the merge status, one of "mergeable" or "conflict", and the list of conflicting paths
+    """
+    worktree_dir = os.path.abspath(repo_dir) + '-worktree'
+    try:
+        execute(['git', '--git-dir', repo_dir, 'worktree', 'add', '--detach', worktree_dir, branch_commit],
+                print_output=print_output)
+        _, _, merge_result = execute(['git', 'merge', '--no-commit', '--no-ff', upstream_commit], cwd=worktree_dir,
+                                     print_output=print_output)
+        if merge_result == 0:
+            return 'mergeable', []
+
+        conflicts, _, _ = execute(['git', 'diff', '--name-only', '--diff-filter=U', '-z'], cwd=worktree_dir,
+                                  print_output=None)
+        return 'conflict', [x for x in conflicts.split('\0') if x != '']
+    finally:
+        shutil.rmtree(worktree_dir, ignore_errors=True)
+        execute(['git', '--git-dir', repo_dir, 'worktree', 'prune'], print_output=print_output)
+
+
+def generate_github_token(github_app_id, github_app_private_key, github_app_installation_id):
+    """
+    Creates a new installation access token for a GitHub App.
+    :param github_app_id: The GitHub App ID
+    :param github_app_private_key: The GitHub App private key in PEM format
+    :param github_app_installation_id: The GitHub App installation ID
+    :return: A tuple with the token and the time it expires, in seconds since the epoch
+    """
+    # Install our own dependencies, skipping pip when the worker already has them. This is only needed when
+    # a new token is created, so runs that reuse a saved token never install or load the JWT library.
+    try:
+        import jwt
+        jwt.jwk_from_pem
+    except (ImportError, AttributeError):
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'jwt'])
+        # A failed or incompatible import leaves the old module cached, so it is dropped before importing the
+        # newly installed package
+        for module in [m for m in sys.modules if m == 'jwt' or m.startswith('jwt.')]:
+            sys.modules.pop(module, None)
+        importlib.invalidate_caches()
+        import jwt
+
+    signing_key = jwt.jwk_from_pem(github_app_private_key.encode('utf-8'))
+
+    payload = {
+        # Issued at time
+        'iat': int(time.time()),
+        # JWT expiration time (10 minutes maximum)
+        'exp': int(time.time()) + 600,
+        # GitHub App's identifier
+        'iss': github_app_id
+    }
+
+    # Create JWT
+    jwt_instance = jwt.JWT()
+    encoded_jwt = jwt_instance.encode(payload, signing_key, alg='RS256')
+
+    # Create access token
+    url = 'https://api.github.com/app/installations/' + github_app_installation_id + '/access_tokens'
+    headers = {
+        'Authorization': 'Bearer ' + encoded_jwt,
+        'Accept': 'application/vnd.github+json',
+        'X-GitHub-Api-Version': '2022-11-28'
+    }
+    request = urllib.request.Request(url, headers=headers, method='POST')
+    response = urllib.request.urlopen(request)
+    response_json = json.loads(response.read().decode())
+
+    # Installation tokens are valid for one hour
+    expires_at = time.time() + 3600
+    if response_json.get('expires_at'):
+        expires_at = datetime.strptime(response_json['expires_at'], '%Y-%m-%dT%H:%M:%SZ').replace(
+            tzinfo=timezone.utc).timestamp()
+
+    return response_json['token'], expires_at
+
+
+def get_github_token(github_app_id, github_app_private_key, github_app_installation_id, cache_dir,
+                     min_lifetime=600):
+    """
+    Returns an installation access token for a GitHub App. Tokens are saved to a file only readable by the current
+    user, keyed by the app and installation IDs and the private key, and reused by later runs until they are about to
+    expire. This avoids signing a JWT and requesting a new token from GitHub every time a runbook runs.
+    :param github_app_id: The GitHub App ID
+    :param github_app_private_key: The GitHub App private key in PEM format
+    :param github_app_installation_id: The GitHub App installation ID
+    :param cache_dir: The directory holding the saved tokens
+    :param min_lifetime: The minimum number of seconds a saved token must remain valid for to be reused
+    :return: The installation access token
+    """
+    # The directory may have been created by an earlier version of this function with the default permissions
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    os.chmod(cache_dir, 0o700)
+
+    # A rotated private key must not reuse a token created with the old key, so the key is part of the file name
+    private_key_hash = hashlib.sha256(github_app_private_key.encode('utf-8')).hexdigest()
+    key = hashlib.sha256((str(github_app_id) + ':' + str(github_app_installation_id) + ':' +
+                          private_key_hash).encode('utf-8')).hexdigest()
+    token_file = os.path.join(cache_dir, key[:16] + '.json')
+
+    # Runbooks can run concurrently on the same worker, so only one process creates a new token at a time.
+    # File locks are not available on Windows workers, where concurrent runs may each create a token.
+    with open(token_file + '.lock', 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(token_file) as f:
+                    saved_token = json.load(f)
+                if saved_token['expires_at'] - time.time() > min_lifetime:
+                    return saved_token['token']
+            except (OSError, ValueError, KeyError):
+                pass
+
+            token, expires_at = generate_github_token(github_app_id, github_app_private_key,
+                                                      github_app_installation_id)
+
+            # The token is written to a new file that is only readable by the current user, and then renamed, so
+            # a partially written token is never read
+            file_descriptor = os.open(token_file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(file_descriptor, 'w') as f:
+                json.dump({'token': token, 'expires_at': expires_at}, f)
+            os.replace(token_file + '.tmp', token_file)
+
+            return token
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
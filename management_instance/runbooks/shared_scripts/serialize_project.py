@@ -1,71 +1,40 @@
 import argparse
+import hashlib
+import json
 import os
 import re
 import socket
 import subprocess
 import sys
+import tempfile
+import time
+import uuid
 from datetime import datetime
 from urllib.parse import urlparse
 from itertools import chain
 import platform
-from urllib.request import urlretrieve
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
-# If this script is not being run as part of an Octopus step, return variables from environment variables.
-# Periods are replaced with underscores, and the variable name is converted to uppercase
-if "get_octopusvariable" not in globals():
-    def get_octopusvariable(variable):
-        return os.environ[re.sub('\\.', '_', variable.upper())]
+# Install our own dependencies, skipping pip when the worker already has them
+try:
+    import requests
+except ImportError:
+    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'requests'])
+    import requests
 
-# If this script is not being run as part of an Octopus step, print directly to std out.
-if "printverbose" not in globals():
-    def printverbose(msg):
-        print(msg)
+from requests.adapters import HTTPAdapter
 
+# Octopus steps prepend the shared helpers to this script. When the script is run directly, they are imported
+# from runbook_helpers.py in the same directory.
+if "execute" not in globals():
+    from runbook_helpers import *
 
-def printverbose_noansi(output):
-    """
-    Strip ANSI color codes and print the output as verbose
-    :param output: The output to print
-    """
-    output_no_ansi = re.sub('\x1b\[[0-9;]*m', '', output)
-    printverbose(output_no_ansi)
-
-
-def get_octopusvariable_quiet(variable):
-    """
-    Gets an octopus variable, or an empty string if it does not exist.
-    :param variable: The variable name
-    :return: The variable value, or an empty string if the variable does not exist
-    """
-    try:
-        return get_octopusvariable(variable)
-    except:
-        return ''
-
-
-def execute(args, cwd=None, env=None, print_args=None, print_output=printverbose_noansi):
-    """
-        The execute method provides the ability to execute external processes while capturing and returning the
-        output to std err and std out and exit code.
-    """
-    process = subprocess.Popen(args,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               text=True,
-                               cwd=cwd,
-                               env=env)
-    stdout, stderr = process.communicate()
-    retcode = process.returncode
-
-    if print_args is not None:
-        print_output(' '.join(args))
-
-    if print_output is not None:
-        print_output(stdout)
-        print_output(stderr)
-
-    return stdout, stderr, retcode
+# Zip entries use a fixed timestamp, the earliest supported by the zip format, so package bytes only depend on the
+# packaged files
+PACKAGE_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+# The manifest added to each package, listing the hash and size of each file
+PACKAGE_MANIFEST = 'octopus_package_manifest.json'
 
 
 def is_windows():
@@ -136,26 +105,64 @@ def init_argparse():
                             'SerializeProject.Exported.Project.IgnoredLibraryVariableSet') or get_octopusvariable_quiet(
                             'Exported.Project.IgnoredLibraryVariableSet'),
                         help='A comma separated list of library variable sets to ignore.')
+    parser.add_argument('--octoterra-image',
+                        action='store',
+                        default=get_octopusvariable_quiet(
+                            'SerializeProject.Docker.Image.Octoterra') or get_octopusvariable_quiet(
+                            'Docker.Image.Octoterra') or 'octopussamples/octoterra',
+                        help='The octoterra Docker image. Pin the image to a digest, like ' +
+                             'octopussamples/octoterra@sha256:..., to only pull it when it is missing.')
+    parser.add_argument('--project-names',
+                        action='store',
+                        default=get_octopusvariable_quiet(
+                            'SerializeProject.Exported.Project.Names') or get_octopusvariable_quiet(
+                            'Exported.Project.Names'),
+                        help='A comma separated list of projects to serialize. This replaces --project-name.')
+    parser.add_argument('--project-name-regex',
+                        action='store',
+                        default=get_octopusvariable_quiet(
+                            'SerializeProject.Exported.Project.NameRegex') or get_octopusvariable_quiet(
+                            'Exported.Project.NameRegex'),
+                        help='A regular expression matching the names of the projects to serialize. ' +
+                             'This replaces --project-name.')
+    parser.add_argument('--all-cac-projects',
+                        action='store',
+                        default=get_octopusvariable_quiet(
+                            'SerializeProject.Exported.Project.AllCac') or get_octopusvariable_quiet(
+                            'Exported.Project.AllCac') or 'false',
+                        help='Set to true to serialize every CaC enabled project in the space. ' +
+                             'This replaces --project-name.')
+    parser.add_argument('--parallelism',
+                        action='store',
+                        default=get_octopusvariable_quiet(
+                            'SerializeProject.Exported.Project.Parallelism') or get_octopusvariable_quiet(
+                            'Exported.Project.Parallelism') or '4',
+                        help='The number of projects to serialize at the same time.')
+    parser.add_argument('--force-upload',
+                        action='store',
+                        default=get_octopusvariable_quiet(
+                            'SerializeProject.Exported.Project.ForceUpload') or get_octopusvariable_quiet(
+                            'Exported.Project.ForceUpload') or 'false',
+                        help='Set to true to upload a new package even if the exported module has not changed ' +
+                             'since the last package was uploaded.')
+    parser.add_argument('--state-dir',
+                        action='store',
+                        default=get_octopusvariable_quiet(
+                            'SerializeProject.Exported.Project.StateDirectory') or get_octopusvariable_quiet(
+                            'Exported.Project.StateDirectory') or os.path.join(tempfile.gettempdir(),
+                                                                               'octopus_serialize_state'),
+                        help='The directory recording the hash of the module in the last uploaded package.')
+    parser.add_argument('--docker-pull-ttl',
+                        action='store',
+                        default=get_octopusvariable_quiet(
+                            'SerializeProject.Docker.Pull.Ttl') or get_octopusvariable_quiet(
+                            'Docker.Pull.Ttl') or '3600',
+                        help='The number of seconds an image that is not pinned to a digest is used for before it ' +
+                             'is pulled again. Set to 0 to pull the images on every run.')
 
     return parser.parse_known_args()
 
 
-def ensure_octo_cli_exists():
-    if is_windows():
-        print("Checking for the Octopus CLI")
-        try:
-            stdout, _, exit_code = execute(['octo', 'help'])
-            printverbose(stdout)
-            if not exit_code == 0:
-                raise "Octo CLI not found"
-        except:
-            print("Downloading the Octopus CLI")
-            urlretrieve('https://download.octopusdeploy.com/octopus-tools/9.0.0/OctopusTools.9.0.0.win-x64.zip',
-                        'OctopusTools.zip')
-            with zipfile.ZipFile('OctopusTools.zip', 'r') as zip_ref:
-                zip_ref.extractall(os.getcwd())
-
-
 def check_docker_exists():
     try:
         stdout, _, exit_code = execute(['docker', 'version'])
@@ -167,8 +174,238 @@ def check_docker_exists():
         sys.exit(1)
 
 
+def get_local_image_id(image):
+    """
+    Returns the ID of a local Docker image.
+    :param image: The image name, including any tag or digest
+    :return: The image ID, or None if the image is not available locally
+    """
+    stdout, _, exit_code = execute(['docker', 'image', 'inspect', '--format', '{{.Id}}', image], print_output=None)
+    return stdout.strip() if exit_code == 0 else None
+
+
+def pull_image(image, ttl, stamp_dir):
+    """
+    Pulls a Docker image unless a current copy is available locally. An image pinned to a digest can not change, so
+    it is only pulled when it is missing. Any other image is pulled again once the TTL has passed since the last pull,
+    or if the local image is no longer the one that was pulled.
+    :param image: The image name, including any tag or digest
+    :param ttl: The number of seconds a pulled image is used for before it is pulled again
+    :param stamp_dir: The directory recording the time and ID of each pulled image
+    """
+    local_image_id = get_local_image_id(image)
+
+    if '@sha256:' in image:
+        if local_image_id is not None:
+            printverbose('Using the local copy of ' + image)
+            return
+    else:
+        stamp_file = os.path.join(stamp_dir, hashlib.sha256(image.encode('utf-8')).hexdigest()[:16] + '.json')
+        try:
+            with open(stamp_file) as f:
+                stamp = json.load(f)
+            if local_image_id is not None and stamp['id'] == local_image_id and time.time() - stamp['time'] < ttl:
+                printverbose('Using the local copy of ' + image + ' pulled at ' +
+                             datetime.fromtimestamp(stamp['time']).isoformat())
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+
+    print('Pulling ' + image)
+    _, _, exit_code = execute(['docker', 'pull', image])
+    if exit_code != 0:
+        # A failed pull is not fatal if an older copy of the image is available
+        return
+
+    if '@sha256:' not in image:
+        os.makedirs(stamp_dir, exist_ok=True)
+        with open(stamp_file + '.tmp', 'w') as f:
+            json.dump({'id': get_local_image_id(image), 'time': time.time()}, f)
+        os.replace(stamp_file + '.tmp', stamp_file)
+
+
+class MultipartFileBody:
+    """
+    A multipart/form-data request body holding a single file. The file is read in chunks as the body is sent, so
+    it is never loaded into memory, and the SHA1 hash of the file is calculated as it is read. The body has a known
+    length, so it is sent with a Content-Length header rather than chunked encoding.
+    """
+
+    def __init__(self, file_path, field_name='file', content_type='application/octet-stream', chunk_size=1024 * 1024):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.boundary = uuid.uuid4().hex
+        self.header = ('--' + self.boundary + '\r\n' +
+                       'Content-Disposition: form-data; name="' + field_name + '"; filename="' +
+                       os.path.basename(file_path) + '"\r\n' +
+                       'Content-Type: ' + content_type + '\r\n\r\n').encode('utf-8')
+        self.footer = ('\r\n--' + self.boundary + '--\r\n').encode('utf-8')
+        self.sha1 = hashlib.sha1()
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=' + self.boundary
+
+    def __len__(self):
+        return len(self.header) + os.path.getsize(self.file_path) + len(self.footer)
+
+    def __iter__(self):
+        self.sha1 = hashlib.sha1()
+        yield self.header
+        with open(self.file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                self.sha1.update(chunk)
+                yield chunk
+        yield self.footer
+
+
+def create_octopus_session(api_key, pool_size=1):
+    """
+    Creates a session that reuses its connections to the Octopus server for every request.
+    :param api_key: The Octopus API key
+    :param pool_size: The number of connections kept open, which matches the number of concurrent requests
+    :return: The requests session
+    """
+    session = requests.Session()
+    session.headers.update({'X-Octopus-ApiKey': api_key, 'Accept': 'application/json'})
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def create_package(source_dir, package_file):
+    """
+    Zips the contents of a directory into a package. Each file is streamed into the zip file, so no copy of the
+    directory is made. Files are added in a fixed order with fixed timestamps and permissions, so packaging the same
+    files always produces the same bytes, which allows packages to be delta compressed against previous versions.
+    A manifest listing the hash and size of each file is added to the package, allowing consumers to find the files
+    that changed between versions.
+    :param source_dir: The directory to package
+    :param package_file: The path of the zip file to create, which must be outside the source directory
+    :return: The manifest, mapping the relative path of each file to its SHA256 hash and size
+    """
+    manifest = {}
+
+    def create_zip_info(name):
+        zip_info = zipfile.ZipInfo(name, date_time=PACKAGE_TIMESTAMP)
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        zip_info.external_attr = 0o644 << 16
+        return zip_info
+
+    with zipfile.ZipFile(package_file, 'w', zipfile.ZIP_DEFLATED) as package:
+        for root, dirs, files in os.walk(source_dir):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                relative_path = os.path.relpath(file_path, source_dir).replace(os.sep, '/')
+                file_hash = hashlib.sha256()
+                with open(file_path, 'rb') as source, package.open(create_zip_info(relative_path), 'w') as target:
+                    for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                        file_hash.update(chunk)
+                        target.write(chunk)
+                manifest[relative_path] = {'sha256': file_hash.hexdigest(), 'size': os.path.getsize(file_path)}
+
+        package.writestr(create_zip_info(PACKAGE_MANIFEST),
+                         json.dumps({'files': manifest}, indent=2, sort_keys=True))
+
+    return manifest
+
+
+def get_changed_files(manifest, previous_manifest):
+    """
+    Compares the manifests of two packages.
+    :param manifest: The manifest of the new package
+    :param previous_manifest: The manifest of the previous package
+    :return: The sorted list of paths that were added, changed or removed
+    """
+    return sorted([path for path in set(manifest) | set(previous_manifest)
+                   if manifest.get(path) != previous_manifest.get(path)])
+
+
+def upload_package(session, server_url, space_id, package_file):
+    """
+    Uploads a package to the built-in feed, replacing any existing package with the same ID and version. The package
+    is streamed as a multipart request, and the SHA1 hash calculated during the upload is compared to the hash
+    Octopus recorded for the package.
+    :param session: The requests session returned by create_octopus_session
+    :param server_url: The Octopus server URL
+    :param space_id: The ID of the space to upload the package to
+    :param package_file: The path to the package, which must be named <package id>.<version>.zip
+    :return: The SHA1 hash of the uploaded package
+    """
+    body = MultipartFileBody(package_file, content_type='application/zip')
+    response = session.post(server_url.rstrip('/') + '/api/' + space_id + '/packages/raw',
+                            params={'replace': 'true'},
+                            data=body,
+                            headers={'Content-Type': body.content_type},
+                            timeout=600)
+    response.raise_for_status()
+
+    package_hash = body.sha1.hexdigest()
+    uploaded_hash = response.json().get('Hash')
+    if uploaded_hash and uploaded_hash.lower() != package_hash:
+        raise ValueError('The package hash recorded by Octopus (' + uploaded_hash +
+                         ') does not match the uploaded package (' + package_hash + ')')
+
+    return package_hash
+
+
+def normalize_hcl(content):
+    """
+    Normalizes the line endings of a Terraform file, which depend on the platform of the worker that exported it.
+    Nothing else is removed, as comments and whitespace inside heredocs, such as step scripts, are part of the module.
+    :param content: The contents of the Terraform file
+    :return: The normalized contents
+    """
+    return content.replace(b'\r\n', b'\n')
+
+
+def hash_export(export_dir):
+    """
+    Calculates a hash of the exported module. Terraform files are normalized before they are hashed, so exports
+    that only differ in line endings have the same hash.
+    :param export_dir: The directory holding the exported module
+    :return: The SHA256 hash of the exported module
+    """
+    export_hash = hashlib.sha256()
+    for root, dirs, files in os.walk(export_dir):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            with open(file_path, 'rb') as f:
+                content = f.read()
+            if file.endswith('.tf'):
+                content = normalize_hcl(content)
+
+            # The path and length are included, so moving content between files changes the hash
+            relative_path = os.path.relpath(file_path, export_dir).replace(os.sep, '/')
+            export_hash.update(relative_path.encode('utf-8') + b'\0' + str(len(content)).encode('utf-8') + b'\0')
+            export_hash.update(content)
+    return export_hash.hexdigest()
+
+
+def get_latest_package_version(session, server_url, space_id, package_id):
+    """
+    Finds the latest version of a package in the built-in feed.
+    :param session: The requests session returned by create_octopus_session
+    :param server_url: The Octopus server URL
+    :param space_id: The ID of the space holding the package
+    :param package_id: The package ID
+    :return: The latest package version, or None if the package does not exist or the feed could not be queried
+    """
+    try:
+        response = session.get(server_url.rstrip('/') + '/api/' + space_id + '/feeds/feeds-builtin/packages/versions',
+                               params={'packageId': package_id, 'take': 1}, timeout=60)
+        response.raise_for_status()
+        versions = response.json().get('Items', [])
+        return versions[0].get('Version') if len(versions) != 0 else None
+    except (requests.RequestException, ValueError) as ex:
+        printverbose('Failed to find the latest version of ' + package_id + ': ' + str(ex))
+        return None
+
+
 check_docker_exists()
-ensure_octo_cli_exists()
 parser, _ = init_argparse()
 
 # Variable precondition checks
@@ -180,10 +417,22 @@ if len(parser.api_key) == 0:
     print("--api-key, ThisInstance.Api.Key, or ThisInstance.Api.Key must be defined")
     sys.exit(1)
 
+# The regular expression is compiled once, so an invalid expression is reported before anything is exported
+project_name_re = None
+if parser.project_name_regex:
+    try:
+        project_name_re = re.compile(parser.project_name_regex)
+    except re.error as ex:
+        print("--project-name-regex, Exported.Project.NameRegex, or SerializeProject.Exported.Project.NameRegex "
+              "is not a valid regular expression: " + str(ex))
+        sys.exit(1)
+
 if not is_windows():
-    print("Pulling the Docker images")
-    execute(['docker', 'pull', 'octopussamples/octoterra'])
-    execute(['docker', 'pull', 'octopusdeploy/octo'])
+    print("Pulling the Docker image")
+    # Pulling an image is a round trip to the registry even when the image is up to date, so it is skipped when
+    # the local image is known to be current
+    pull_stamp_dir = os.path.join(tempfile.gettempdir(), 'octopus_docker_pulls')
+    pull_image(parser.octoterra_image, int(parser.docker_pull_ttl), pull_stamp_dir)
 
 # Find out the IP address of the Octopus container
 parsed_url = urlparse(parser.server_url)
@@ -196,140 +445,224 @@ print("Octopus IP: " + octopus.strip())
 ignores_library_variable_sets = parser.ignored_library_variable_sets.split(',')
 ignores_library_variable_sets_args = [['-excludeLibraryVariableSet', x] for x in ignores_library_variable_sets]
 
-octoterra_image = 'octopussamples/octoterra-windows' if is_windows() else 'octopussamples/octoterra'
+octoterra_image = 'octopussamples/octoterra-windows' if is_windows() else parser.octoterra_image
 octoterra_mount = 'C:/export' if is_windows() else '/export'
 
-os.mkdir(os.getcwd() + '/export')
-
-export_args = ['docker', 'run',
-               '--rm',
-               '--add-host=' + parsed_url.hostname + ':' + octopus.strip(),
-               '-v', os.getcwd() + '/export:' + octoterra_mount,
-               octoterra_image,
-               # the url of the instance
-               '-url', parser.server_url,
-               # the api key used to access the instance
-               '-apiKey', parser.api_key,
-               # add a postgres backend to the generated modules
-               '-terraformBackend', parser.terraform_backend,
-               # dump the generated HCL to the console
-               '-console',
-               # dump the project from the current space
-               '-space', parser.space_id,
-               # the name of the project to serialize
-               '-projectName', parser.project_name,
-               # ignoreProjectChanges can be set to ignore all changes to the project, variables, runbooks etc
-               '-ignoreProjectChanges=' + parser.ignore_all_changes,
-               # use data sources to lookup external dependencies (like environments, accounts etc) rather
-               # than serialize those external resources
-               '-lookupProjectDependencies',
-               # for any secret variables, add a default value set to the octostache value of the variable
-               # e.g. a secret variable called "database" has a default value of "#{database}"
-               '-defaultSecretVariableValues',
-               # detach any step templates, allowing the exported project to be used in a new space
-               '-detachProjectTemplates',
-               # allow the downstream project to move between project groups
-               '-ignoreProjectGroupChanges',
-               # allow the downstream project to change names
-               '-ignoreProjectNameChanges',
-               # CaC enabled projects will not export the deployment process, non-secret variables, and other
-               # CaC managed project settings if ignoreCacManagedValues is true. It is usually desirable to
-               # set this value to true, but it is false here because CaC projects created by Terraform today
-               # save some variables in the database rather than writing them to the Git repo.
-               '-ignoreCacManagedValues=' + parser.ignore_cac_managed_values,
-               # This value is always true. Either this is an unmanaged project, in which case we are never
-               # reapplying it; or it is a variable configured project, in which case we need to ignore
-               # variable changes, or it is a shared CaC project, in which case we don't use Terraform to
-               # manage variables.
-               '-ignoreProjectVariableChanges',
-               # To have secret variables available when applying a downstream project, they must be scoped
-               # to the Sync environment. But we do not need this scoping in the downstream project, so the
-               # Sync environment is removed from any variable scopes when serializing it to Terraform.
-               '-excludeVariableEnvironmentScopes', 'Sync',
-               # Exclude any variables starting with "Private."
-               '-excludeProjectVariableRegex', 'Private\\..*',
-               # Capture the octopus endpoint, space ID, and space name as output vars. This is useful when
-               # querying th Terraform state file to know which space and instance the resources were
-               # created in. The scripts used to update downstream projects in bulk work by querying the
-               # Terraform state, finding all the downstream projects, and using the space name to only process
-               # resources that match the current tenant (because space names and tenant names are the same).
-               # The output variables added by this option are octopus_server, octopus_space_id, and
-               # octopus_space_name.
-               '-includeOctopusOutputVars',
-               # Where steps do not explicitly define a worker pool and reference the default one, this
-               # option explicitly exports the default worker pool by name. This means if two spaces have
-               # different default pools, the exported project still uses the pool that the original project
-               # used.
-               '-lookUpDefaultWorkerPools',
-               # These tenants are linked to the project to support some management runbooks, but should not
-               # be exported
-               '-excludeAllTenants',
-               # The directory where the exported files will be saved
-               '-dest', octoterra_mount,
-               # This is a management runbook that we do not wish to export
-               '-excludeRunbookRegex', '__ .*'] + list(chain(*ignores_library_variable_sets_args))
-
-print("Exporting Terraform module")
-stdout, _, octoterra_exit = execute(export_args)
-
-printverbose(stdout)
-
-if not octoterra_exit == 0:
-    print("Octoterra failed. Please check the logs for more information.")
-    sys.exit(1)
 
-date = datetime.now().strftime('%Y.%m.%d.%H%M%S')
-
-print("Creating Terraform module package")
-if is_windows():
-    execute(['octo',
-             'pack',
-             '--format', 'zip',
-             '--id', re.sub('[^0-9a-zA-Z]', '_', parser.project_name),
-             '--version', date,
-             '--basePath', 'C:\\export',
-             '--outFolder', 'C:\\export'])
-    printverbose(stdout)
-else:
-    stdout, _, _ = execute(['docker', 'run',
-                            '--rm',
-                            '--add-host=' + parsed_url.hostname + ':' + octopus.strip(),
-                            '-v', os.getcwd() + "/export:/export",
-                            'octopusdeploy/octo',
-                            'pack',
-                            '--format', 'zip',
-                            '--id', re.sub('[^0-9a-zA-Z]', '_', parser.project_name),
-                            '--version', date,
-                            '--basePath', '/export',
-                            '--outFolder', '/export'])
-    printverbose(stdout)
-
-print("Uploading Terraform module package")
-if is_windows():
-    stdout, _, _ = execute(['octo',
-                            'push',
-                            '--apiKey', parser.api_key,
-                            '--server', parser.server_url,
-                            '--space', parser.upload_space_id,
-                            '--package', 'C:\\export\\' +
-                            re.sub('[^0-9a-zA-Z]', '_', parser.project_name) + '.' + date + '.zip',
-                            '--replace-existing'])
-    printverbose(stdout)
-else:
-    stdout, _, _ = execute(['docker', 'run',
-                            '--rm',
-                            '--add-host=' + parsed_url.hostname + ':' + octopus.strip(),
-                            '-v', os.getcwd() + "/export:/export",
-                            'octopusdeploy/octo',
-                            'push',
-                            '--apiKey', parser.api_key,
-                            '--server', parser.server_url,
-                            '--space', parser.upload_space_id,
-                            '--package', '/export/' +
-                            re.sub('[^0-9a-zA-Z]', '_', parser.project_name) + '.' + date + '.zip',
-                            '--replace-existing'])
-    printverbose(stdout)
+def get_export_args(project_name, export_dir):
+    """
+    Builds the arguments used to export a project with octoterra.
+    :param project_name: The name of the project to serialize
+    :param export_dir: The directory the Terraform module is saved to
+    :return: The arguments to pass to execute()
+    """
+    return ['docker', 'run',
+            '--rm',
+            '--add-host=' + parsed_url.hostname + ':' + octopus.strip(),
+            '-v', export_dir + ':' + octoterra_mount,
+            octoterra_image,
+            # the url of the instance
+            '-url', parser.server_url,
+            # the api key used to access the instance
+            '-apiKey', parser.api_key,
+            # add a postgres backend to the generated modules
+            '-terraformBackend', parser.terraform_backend,
+            # dump the generated HCL to the console
+            '-console',
+            # dump the project from the current space
+            '-space', parser.space_id,
+            # the name of the project to serialize
+            '-projectName', project_name,
+            # ignoreProjectChanges can be set to ignore all changes to the project, variables, runbooks etc
+            '-ignoreProjectChanges=' + parser.ignore_all_changes,
+            # use data sources to lookup external dependencies (like environments, accounts etc) rather
+            # than serialize those external resources
+            '-lookupProjectDependencies',
+            # for any secret variables, add a default value set to the octostache value of the variable
+            # e.g. a secret variable called "database" has a default value of "#{database}"
+            '-defaultSecretVariableValues',
+            # detach any step templates, allowing the exported project to be used in a new space
+            '-detachProjectTemplates',
+            # allow the downstream project to move between project groups
+            '-ignoreProjectGroupChanges',
+            # allow the downstream project to change names
+            '-ignoreProjectNameChanges',
+            # CaC enabled projects will not export the deployment process, non-secret variables, and other
+            # CaC managed project settings if ignoreCacManagedValues is true. It is usually desirable to
+            # set this value to true, but it is false here because CaC projects created by Terraform today
+            # save some variables in the database rather than writing them to the Git repo.
+            '-ignoreCacManagedValues=' + parser.ignore_cac_managed_values,
+            # This value is always true. Either this is an unmanaged project, in which case we are never
+            # reapplying it; or it is a variable configured project, in which case we need to ignore
+            # variable changes, or it is a shared CaC project, in which case we don't use Terraform to
+            # manage variables.
+            '-ignoreProjectVariableChanges',
+            # To have secret variables available when applying a downstream project, they must be scoped
+            # to the Sync environment. But we do not need this scoping in the downstream project, so the
+            # Sync environment is removed from any variable scopes when serializing it to Terraform.
+            '-excludeVariableEnvironmentScopes', 'Sync',
+            # Exclude any variables starting with "Private."
+            '-excludeProjectVariableRegex', 'Private\\..*',
+            # Capture the octopus endpoint, space ID, and space name as output vars. This is useful when
+            # querying th Terraform state file to know which space and instance the resources were
+            # created in. The scripts used to update downstream projects in bulk work by querying the
+            # Terraform state, finding all the downstream projects, and using the space name to only process
+            # resources that match the current tenant (because space names and tenant names are the same).
+            # The output variables added by this option are octopus_server, octopus_space_id, and
+            # octopus_space_name.
+            '-includeOctopusOutputVars',
+            # Where steps do not explicitly define a worker pool and reference the default one, this
+            # option explicitly exports the default worker pool by name. This means if two spaces have
+            # different default pools, the exported project still uses the pool that the original project
+            # used.
+            '-lookUpDefaultWorkerPools',
+            # These tenants are linked to the project to support some management runbooks, but should not
+            # be exported
+            '-excludeAllTenants',
+            # The directory where the exported files will be saved
+            '-dest', octoterra_mount,
+            # This is a management runbook that we do not wish to export
+            '-excludeRunbookRegex', '__ .*'] + list(chain(*ignores_library_variable_sets_args))
+
+
+def find_project_names():
+    """
+    Finds the projects to serialize. A single project is serialized unless a list of projects, a regular
+    expression, or all CaC enabled projects are selected.
+    :return: The names of the projects to serialize
+    """
+    project_names = [x.strip() for x in parser.project_names.split(',') if x.strip()]
+
+    if project_name_re is not None or parser.all_cac_projects.casefold() == 'true':
+        response = session.get(parser.server_url.rstrip('/') + '/api/' + parser.space_id + '/projects/all',
+                               timeout=60)
+        response.raise_for_status()
+        for project in response.json():
+            if project_name_re is not None and project_name_re.search(project['Name']):
+                project_names.append(project['Name'])
+            elif parser.all_cac_projects.casefold() == 'true' and project.get('IsVersionControlled'):
+                project_names.append(project['Name'])
+    elif len(project_names) == 0:
+        project_names = [parser.project_name]
+
+    # Remove duplicates while keeping the order
+    return list(dict.fromkeys(project_names))
+
+
+def serialize_project(index, project_name):
+    """
+    Exports a project to a Terraform module, and uploads the module as a package if it changed since the last upload.
+    This function is run concurrently, so all output is captured and returned rather than printed directly.
+    :param index: The index of the project, used to create a unique export directory
+    :param project_name: The name of the project to serialize
+    :return: A tuple with the status, one of "uploaded", "unchanged" or "failed", the number of seconds taken, and a
+    list of (print function, message) tuples to be replayed in order by the caller
+    """
+    messages = []
+    start = time.monotonic()
+
+    def capture_verbose(output):
+        messages.append((printverbose_noansi, output))
+
+    def capture(output):
+        messages.append((print, output))
+
+    def result(status):
+        return status, time.monotonic() - start, messages
+
+    # A failure in one project is recorded, and the remaining projects are still serialized
+    try:
+        export_dir = os.path.join(os.getcwd(), 'export', str(index))
+        os.makedirs(export_dir)
+
+        capture("Exporting Terraform module for " + project_name)
+        _, _, octoterra_exit = execute(get_export_args(project_name, export_dir), print_output=capture_verbose)
+
+        if not octoterra_exit == 0:
+            capture("Octoterra failed. Please check the logs for more information.")
+            return result('failed')
+
+        date = datetime.now().strftime('%Y.%m.%d.%H%M%S')
+        package_id = NON_ALPHANUMERIC_RE.sub('_', project_name)
+
+        package_file = os.path.join(os.getcwd(), package_id + '.' + date + '.zip')
+
+        # The hash of the module in the last uploaded package is recorded for each server, space and package
+        export_hash = hash_export(export_dir)
+        state_key = hashlib.sha256(
+            '\n'.join([parser.server_url, parser.upload_space_id, package_id]).encode('utf-8')).hexdigest()
+        state_file = os.path.join(parser.state_dir, state_key[:16] + '.json')
+
+        try:
+            with open(state_file) as f:
+                previous_upload = json.load(f)
+        except (OSError, ValueError):
+            previous_upload = {}
+
+        capture_verbose("Export hash: " + export_hash)
+
+        # The recorded upload is only trusted if it is still the latest package, as another worker may have uploaded a
+        # different module since
+        if parser.force_upload.casefold() != 'true' and previous_upload.get('export_hash') == export_hash and \
+                previous_upload.get('version') is not None and \
+                get_latest_package_version(session, parser.server_url, parser.upload_space_id, package_id) == \
+                previous_upload.get('version'):
+            capture("The exported module has not changed since version " + previous_upload['version'] +
+                    " was uploaded, so no new package was created")
+            return result('unchanged')
+
+        capture("Creating Terraform module package")
+        manifest = create_package(export_dir, package_file)
+        if 'files' in previous_upload:
+            changed_files = get_changed_files(manifest, previous_upload['files'])
+            capture_verbose("Files changed since version " + str(previous_upload.get('version')) + ": " +
+                            (', '.join(changed_files) or 'none'))
+
+        capture("Uploading Terraform module package")
+        try:
+            package_hash = upload_package(session, parser.server_url, parser.upload_space_id, package_file)
+        except (requests.RequestException, ValueError) as ex:
+            capture("Failed to upload the package: " + str(ex))
+            return result('failed')
+
+        capture("Uploaded " + os.path.basename(package_file) + " with SHA1 hash " + package_hash)
+
+        os.makedirs(parser.state_dir, exist_ok=True)
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump({'export_hash': export_hash, 'version': date, 'package_hash': package_hash, 'files': manifest}, f)
+        os.replace(state_file + '.tmp', state_file)
+
+        return result('uploaded')
+    except (OSError, subprocess.SubprocessError, requests.RequestException, ValueError) as ex:
+        capture("Failed to serialize " + project_name + ": " + str(ex))
+        return result('failed')
+
+
+parallelism = max(1, int(parser.parallelism))
+session = create_octopus_session(parser.api_key, parallelism)
+project_names = find_project_names()
+
+# Projects are serialized concurrently, but executor.map() returns the results in the order the projects were
+# found, so the log is stable between runs
+results = []
+with ThreadPoolExecutor(max_workers=parallelism) as executor:
+    for project_name, (status, seconds, messages) in zip(
+            project_names, executor.map(serialize_project, range(len(project_names)), project_names)):
+        for print_func, message in messages:
+            print_func(message)
+        results.append((project_name, status, seconds))
 
 print("##octopus[stdout-default]")
 
+if len(project_names) > 1:
+    for project_name, status, seconds in results:
+        print(project_name + ": " + status + " (" + format(seconds, '.1f') + "s)")
+
+failed_projects = [project_name for project_name, status, _ in results if status == 'failed']
+print("Serialized " + str(len(project_names) - len(failed_projects)) + " of " + str(len(project_names)) + " projects")
+
+if len(failed_projects) != 0:
+    print("Failed to serialize the following projects: " + ', '.join(failed_projects))
+    sys.exit(1)
+
 print("Done")
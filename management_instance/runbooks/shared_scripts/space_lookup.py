@@ -9,13 +9,12 @@ import urllib.parse
 import os
 import sys
 import time
-import re
 
 # If this script is not being run as part of an Octopus step, return variables from environment variables.
 # Periods are replaced with underscores, and the variable name is converted to uppercase
 if "get_octopusvariable" not in globals():
     def get_octopusvariable(variable):
-        return os.environ[re.sub('\\.', '_', variable.upper())]
+        return os.environ[variable.upper().replace('.', '_')]
 
 # If this script is not being run as part of an Octopus step, just print any set variable to std out.
 if "set_octopusvariable" not in globals():
@@ -0,0 +1,122 @@
+import argparse
+import ast
+import os
+import shutil
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serialize_project.py')
+
+MODULE = '''resource "octopusdeploy_runbook_process" "runbook" {
+  step {
+    action {
+      properties = {
+        "Octopus.Action.Script.ScriptBody" = <<EOT
+# Deploy to #{Octopus.Environment.Name}
+echo "Deploying"
+EOT
+      }
+    }
+  }
+}
+'''
+
+
+def load_script():
+    """
+    Loads the functions defined by serialize_project.py. The script exports and uploads projects when it is run, so
+    only the imports, constants and definitions are executed.
+    :return: The namespace holding the functions
+    """
+    with open(SCRIPT) as f:
+        tree = ast.parse(f.read())
+
+    def is_definition(node):
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.Try, ast.FunctionDef, ast.ClassDef)):
+            return True
+        if isinstance(node, ast.Assign):
+            return all(isinstance(target, ast.Name) and target.id.isupper() for target in node.targets)
+        # The fallbacks used when the script is not run by Octopus
+        return isinstance(node, ast.If) and 'globals()' in ast.unparse(node.test)
+
+    namespace = {}
+    tree.body = [node for node in tree.body if is_definition(node)]
+    exec(compile(tree, SCRIPT, 'exec'), namespace)
+    return namespace
+
+
+class SerializeProjectTest(unittest.TestCase):
+    """
+    Tests the detection of unchanged Terraform modules, which skips uploading a new package
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.work_dir)
+
+        self.script = load_script()
+        self.uploads = []
+        self.module = MODULE
+
+        def execute(args, print_output=None):
+            with open(os.path.join(args[1], 'main.tf'), 'w', newline='') as f:
+                f.write(self.module)
+            return '', '', 0
+
+        def upload_package(session, server_url, space_id, package_file):
+            self.uploads.append(package_file)
+            return 'hash' + str(len(self.uploads))
+
+        self.script.update({
+            'parser': argparse.Namespace(state_dir=os.path.join(self.work_dir, 'state'), server_url='http://octopus',
+                                         upload_space_id='Spaces-1', force_upload='false'),
+            'session': None,
+            'get_export_args': lambda project_name, export_dir: [project_name, export_dir],
+            'execute': execute,
+            'upload_package': upload_package,
+            'get_latest_package_version': lambda session, server_url, space_id, package_id: self.latest_version()
+        })
+
+    def latest_version(self):
+        with open(os.path.join(self.script['parser'].state_dir, os.listdir(self.script['parser'].state_dir)[0])) as f:
+            return self.script['json'].load(f)['version']
+
+    def serialize(self, index):
+        status, _, _ = self.script['serialize_project'](index, 'Project')
+        return status
+
+    def test_unchanged_module_is_not_uploaded(self):
+        self.assertEqual('uploaded', self.serialize(0))
+        self.assertEqual('unchanged', self.serialize(1))
+        self.assertEqual(1, len(self.uploads))
+
+    def test_line_endings_do_not_change_module(self):
+        self.assertEqual('uploaded', self.serialize(0))
+        self.module = MODULE.replace('\n', '\r\n')
+        self.assertEqual('unchanged', self.serialize(1))
+
+    def test_script_comment_changes_module(self):
+        self.assertEqual('uploaded', self.serialize(0))
+        self.module = MODULE.replace('# Deploy to', '# Deploying to')
+        self.assertEqual('uploaded', self.serialize(1))
+        self.assertEqual(2, len(self.uploads))
+
+    def test_script_whitespace_changes_module(self):
+        self.assertEqual('uploaded', self.serialize(0))
+        self.module = MODULE.replace('echo "Deploying"', 'echo "Deploying"  ')
+        self.assertEqual('uploaded', self.serialize(1))
+
+    def test_project_failure_is_recorded(self):
+        def execute(args, print_output=None):
+            raise OSError('docker was not found')
+
+        self.script['execute'] = execute
+        status, _, messages = self.script['serialize_project'](0, 'Project')
+        self.assertEqual('failed', status)
+        self.assertIn('Failed to serialize Project: docker was not found', [message for _, message in messages])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,71 +13,123 @@ const ManualInterventionType = "Octopus.Manual"
  * @returns {Promise<unknown>} A promise with true if the validation succeeded, and false otherwise
  */
 function checkPr(ocl) {
-    return new Promise((resolve, reject) => {
-        // Read the deployment process OCL file
-        fs.readFile(ocl, 'utf8', (err, data) => {
-            // Any error reading the file fails the script
-            if (err) {
-                console.error(err)
-                resolve(false)
-                return
-            }
+    return checkFile(ocl)
+        .then(result => {
+            result.messages.forEach(message => result.error ? console.error(message) : console.log(message))
+            return result.success
+        })
+}
 
-            // These come from the @octopusdeploy/ocl dependency
-            const lexer = new Lexer(data)
-            const parser = new Parser(lexer)
-            const steps = parser.getAST()
+/**
+ * Validates the contents of a deployment process OCL file. This function has no side effects, so it can be called
+ * for any number of files from a single process.
+ * @param data The contents of the deployment_process.ocl file
+ * @returns {{success: boolean, messages: string[]}} The result of the validation
+ */
+function validateOcl(data) {
+    // These come from the @octopusdeploy/ocl dependency
+    const lexer = new Lexer(data)
+    const parser = new Parser(lexer)
+    const steps = parser.getAST()
+
+    // Test that we have any steps at all
+    if (steps.length === 0) {
+        return {success: false, messages: ["Deployment process can not be empty"]}
+    }
 
-            // Test that we have any steps at all
-            if (steps.length === 0) {
-                console.log("Deployment process can not be empty")
-                resolve(false)
-                return
-            }
+    const firstStepName = getUnquotedPropertyValue(getProperty(steps[0], "name"))
 
-            const firstStepName = getUnquotedPropertyValue(getProperty(steps[0], "name"))
+    if (!firstStepName) {
+        return {success: false, messages: ["Failed to find the name of the first step"]}
+    }
 
-            if (!firstStepName) {
-                console.log("Failed to find the name of the first step")
-                resolve(false)
-                return
-            }
+    if (firstStepName !== FirstStepName) {
+        return {
+            success: false,
+            messages: ["First step must be called " + FirstStepName + " (was " + firstStepName + ")"]
+        }
+    }
 
-            if (firstStepName !== FirstStepName) {
-                console.log("First step must be called " + FirstStepName + " (was " + firstStepName + ")")
-                resolve(false)
-                return
-            }
+    const action = getBlock(steps[0], "action")
+    const actionType = getUnquotedPropertyValue(getProperty(action, "action_type"))
 
-            const action = getBlock(steps[0], "action")
-            const actionType = getUnquotedPropertyValue(getProperty(action, "action_type"))
+    if (actionType !== ManualInterventionType) {
+        return {success: false, messages: ["First step must be a manual intervention step (was " + actionType + ")"]}
+    }
 
-            if (actionType !== ManualInterventionType) {
-                console.log("First step must be a manual intervention step (was " + actionType + ")")
-                resolve(false)
-                return
-            }
+    return {success: true, messages: ["All tests passed!"]}
+}
 
-            console.log("All tests passed!")
-            resolve(true)
-        })
+/**
+ * Reads and validates a deployment process OCL file
+ * @param ocl The OCL file to parse, or a directory holding a deployment_process.ocl file
+ * @returns {Promise<{path: string, success: boolean, error: boolean, messages: string[]}>} A promise with the result
+ * of the validation. Any error reading or parsing the file fails the validation.
+ */
+function checkFile(ocl) {
+    return fs.promises.stat(ocl)
+        .then(stats => stats.isDirectory() ? path.join(ocl, "deployment_process.ocl") : ocl)
+        .catch(() => ocl)
+        .then(file => fs.promises.readFile(file, 'utf8')
+            .then(data => ({path: file, error: false, ...validateOcl(data)}))
+            .catch(err => ({path: file, success: false, error: true, messages: [err.toString()]})))
+}
+
+/**
+ * Validates many deployment process OCL files in one pass
+ * @param ocls The OCL files to parse, or directories holding a deployment_process.ocl file
+ * @returns {Promise<Array>} A promise with the result of each validation, in the order the files were supplied
+ */
+function checkFiles(ocls) {
+    return Promise.all(ocls.map(checkFile))
+}
+
+/**
+ * Reads the newline separated list of paths passed to stdin
+ * @returns {Promise<string[]>} A promise with the paths
+ */
+function readStdinPaths() {
+    return new Promise((resolve, reject) => {
+        let input = ""
+        process.stdin.setEncoding("utf8")
+        process.stdin.on("data", chunk => input += chunk)
+        process.stdin.on("end", () => resolve(input.split(/\r?\n/).map(p => p.trim()).filter(p => p)))
+        process.stdin.on("error", reject)
     })
 }
 
 // This is the entry point when the file is run by Node.js
 if (require.main === module) {
     /*
-        Ensure the path to the directory holding the deployment_process.ocl file was passed as an argument (with the
-        other 2 arguments being the node executable itself and the name of this script file).
+        The arguments are the paths to the directories holding the deployment_process.ocl files, or the OCL files
+        themselves (with the first 2 arguments being the node executable itself and the name of this script file).
+        Pass "-" to read a newline separated list of paths from stdin, and "--json" to print the results as JSON.
     */
-    if (process.argv.length !== 3) {
+    const args = process.argv.slice(2)
+    const json = args.includes("--json")
+    const paths = args.filter(a => a !== "--json" && a !== "-")
+
+    if (paths.length === 0 && !args.includes("-")) {
         console.log("Pass the directory holding the deployment_process.ocl file as the first argument")
         process.exit(1)
     }
 
-    checkPr(path.join(process.argv[2], 'deployment_process.ocl'))
-        .then(result => {
-            process.exit(result ? 0 : 1)
+    (args.includes("-") ? readStdinPaths() : Promise.resolve([]))
+        .then(stdinPaths => checkFiles(paths.concat(stdinPaths)))
+        .then(results => {
+            if (json) {
+                console.log(JSON.stringify(results.map(r => ({
+                    path: r.path,
+                    success: r.success,
+                    messages: r.messages
+                }))))
+            } else if (results.length === 1) {
+                results[0].messages.forEach(m => results[0].error ? console.error(m) : console.log(m))
+            } else {
+                results.forEach(r => r.messages.forEach(m => console.log(r.path + ": " + m)))
+            }
+
+            process.exit(results.every(r => r.success) ? 0 : 1)
         })
 }
 
@@ -167,4 +219,7 @@ function getUnquotedPropertyValue(ast) {
     return result === null ? value : result[1]
 }
 
-exports.checkPr = checkPr
\ No newline at end of file
+exports.checkPr = checkPr
+exports.checkFile = checkFile
+exports.checkFiles = checkFiles
+exports.validateOcl = validateOcl
\ No newline at end of file
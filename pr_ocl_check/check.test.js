@@ -1,4 +1,5 @@
-const {checkPr} = require('./check')
+const {checkPr, checkFiles, validateOcl} = require('./check')
+const fs = require('fs')
 
 test('fail a process definition where the first step does not have the correct name', async () => {
     const result = await checkPr('./test_deployment_processes/wrong_name.ocl')
@@ -13,4 +14,33 @@ test('pass a process definition where the first step does not have the correct n
 test('fail a process definition where the first step does not have the correct type', async () => {
     const result = await checkPr('./test_deployment_processes/correct_name_wrong_type.ocl')
     expect(result).toBe(false)
-})
\ No newline at end of file
+})
+
+test('validate the contents of a process definition without reading a file', () => {
+    const result = validateOcl(fs.readFileSync('./test_deployment_processes/correct_name.ocl', 'utf8'))
+    expect(result.success).toBe(true)
+})
+
+test('fail an empty process definition', () => {
+    const result = validateOcl('')
+    expect(result.success).toBe(false)
+    expect(result.messages).toEqual(['Deployment process can not be empty'])
+})
+
+test('check many process definitions in one pass', async () => {
+    const results = await checkFiles([
+        './test_deployment_processes/correct_name.ocl',
+        './test_deployment_processes/wrong_name.ocl',
+        './test_deployment_processes/correct_name_wrong_type.ocl'])
+    expect(results.map(r => r.success)).toEqual([true, false, false])
+    expect(results.map(r => r.path)).toEqual([
+        './test_deployment_processes/correct_name.ocl',
+        './test_deployment_processes/wrong_name.ocl',
+        './test_deployment_processes/correct_name_wrong_type.ocl'])
+})
+
+test('fail a process definition that can not be read', async () => {
+    const results = await checkFiles(['./test_deployment_processes/missing.ocl'])
+    expect(results[0].success).toBe(false)
+    expect(results[0].error).toBe(true)
+})